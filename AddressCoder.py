@@ -1,4 +1,5 @@
-from Crypto.Hash import SHA256
+import hashlib
+
 from Crypto.Hash import RIPEMD160
 
 BASE58_ALPHABET_TABLE = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
@@ -9,7 +10,9 @@ def hash160(s):
     :param s:
     :return:
     """
-    return RIPEMD160.new(SHA256.new(s).digest()).digest()
+    # hashlib's sha256 is much cheaper per call than a Crypto.Hash object,
+    # which matters when deriving addresses for many keys
+    return RIPEMD160.new(hashlib.sha256(s).digest()).digest()
 
 def decode_base58(s):
     num = 0
@@ -41,7 +44,7 @@ def hash256(s):
     """
     two rounds of sha256 to against birthday attack.
     """
-    return SHA256.new(SHA256.new(s).digest()).digest()
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
 def encode_base58_checksum(b):
     return encode_base58(b + hash256(b)[:4])
@@ -77,4 +80,47 @@ def encode_varint(len_int):
     elif len_int < 0x10000000000000000:
         return b'\xff' + len_int.to_bytes(8, 'little')
     else:
-        raise ValueError('integer too large: {}'.format(len_int))
\ No newline at end of file
+        raise ValueError('integer too large: {}'.format(len_int))
+
+def varint_size(len_int):
+    '''
+    returns how many bytes encode_varint uses for an integer
+    '''
+    if len_int < 0xfd:
+        return 1
+    elif len_int < 0x10000:
+        return 3
+    elif len_int < 0x100000000:
+        return 5
+    elif len_int < 0x10000000000000000:
+        return 9
+    else:
+        raise ValueError('integer too large: {}'.format(len_int))
+
+
+def write_varint(buf, offset, len_int):
+    '''
+    writes an integer as a varint into buf at offset, returns the offset
+    just past it
+    '''
+    return write_bytes(buf, offset, encode_varint(len_int))
+
+def check_space(buf, offset, size):
+    '''
+    raises ValueError unless size bytes fit in buf at offset; writers check
+    once up front, so a short buf fails the same way whichever field would
+    have run out of room
+    '''
+    end = offset + size
+    if end > len(buf):
+        raise ValueError('buffer too short: {} bytes needed, {} given'.format(end, len(buf)))
+    return end
+
+def write_bytes(buf, offset, data):
+    '''
+    copies data into buf at offset, returns the offset just past it; raises
+    ValueError rather than growing a buf that is too short
+    '''
+    end = check_space(buf, offset, len(data))
+    buf[offset:end] = data
+    return end
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+from random import randint
+from unittest import TestCase, skipUnless
+
+from Crypto.Hash import RIPEMD160
+
+from AddressCoder import hash160, hash256
+from PrivateKey import PrivateKey
+from S256Point import S256Point, SECP_256K1_N
+from Signature import Signature
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+# BITCOINDEMO_CRYPTO_BACKEND picks the backend at import time: 'python'
+# (the default), 'native', or 'auto' for native whenever it is installed
+BACKEND_ENV = 'BITCOINDEMO_CRYPTO_BACKEND'
+
+
+class PythonBackend:
+    '''
+    The curve math of this package: PrivateKey, S256Point and AddressCoder.
+    '''
+    name = 'python'
+
+    def pubkey(self, secret, compressed=True):
+        return PrivateKey(secret).point.sec(compressed)
+
+    def sign(self, secret, z):
+        return PrivateKey(secret).sign(z)
+
+    def verify(self, sec, z, sig):
+        return S256Point.parse(sec).verify(z, sig)
+
+    def parse_sec(self, sec):
+        return S256Point.parse(sec)
+
+    def serialize_sec(self, point, compressed=True):
+        return point.sec(compressed)
+
+    def hash160(self, s):
+        return hash160(s)
+
+    def hash256(self, s):
+        return hash256(s)
+
+
+class NativeBackend:
+    '''
+    libsecp256k1 through the coincurve binding, with hashing in hashlib.
+    Signatures are the same RFC 6979 low-S signatures PythonBackend makes.
+    '''
+    name = 'native'
+
+    def __init__(self):
+        if coincurve is None:
+            raise ImportError('the native backend needs the coincurve package')
+        try:
+            hashlib.new('ripemd160')
+            self.ripemd160 = lambda s: hashlib.new('ripemd160', s).digest()
+        except ValueError:
+            # OpenSSL 3 may not ship ripemd160
+            self.ripemd160 = lambda s: RIPEMD160.new(s).digest()
+
+    def pubkey(self, secret, compressed=True):
+        return coincurve.PrivateKey(secret.to_bytes(32, 'big')).public_key.format(compressed)
+
+    def sign(self, secret, z):
+        der = coincurve.PrivateKey(secret.to_bytes(32, 'big')).sign(z.to_bytes(32, 'big'), hasher=None)
+        return Signature.parse(der)
+
+    def verify(self, sec, z, sig):
+        if not (0 < sig.r < SECP_256K1_N and 0 < sig.s < SECP_256K1_N):
+            return False
+        # libsecp256k1 only accepts low-S signatures, and (r, N - s) is
+        # valid exactly when (r, s) is
+        if sig.s > SECP_256K1_N // 2:
+            sig = Signature(sig.r, SECP_256K1_N - sig.s)
+        return coincurve.PublicKey(bytes(sec)).verify(sig.der(), z.to_bytes(32, 'big'), hasher=None)
+
+    def parse_sec(self, sec):
+        x, y = coincurve.PublicKey(bytes(sec)).point()
+        return S256Point(x, y)
+
+    def serialize_sec(self, point, compressed=True):
+        return coincurve.PublicKey.from_point(point.x.num, point.y.num).format(compressed)
+
+    def hash160(self, s):
+        return self.ripemd160(hashlib.sha256(s).digest())
+
+    def hash256(self, s):
+        return hashlib.sha256(hashlib.sha256(s).digest()).digest()
+
+
+def select_backend(name=None):
+    '''
+    returns the backend called name, falling back to the Python one when
+    the native binding is missing
+    '''
+    if name is None:
+        name = os.environ.get(BACKEND_ENV, 'python')
+    if name == 'python':
+        return PythonBackend()
+    if name not in ('native', 'auto'):
+        raise ValueError('unknown crypto backend: {}'.format(name))
+    if coincurve is None:
+        if name == 'native':
+            logging.warning('coincurve is not installed, using the python crypto backend')
+        return PythonBackend()
+    return NativeBackend()
+
+
+BACKEND = select_backend()
+
+
+def use_backend(name):
+    '''
+    switches the shared backend after import, e.g. in tests
+    '''
+    global BACKEND
+    BACKEND = select_backend(name)
+    return BACKEND
+
+
+class CryptoBackendTest(TestCase):
+    def test_select_backend(self):
+        self.assertEqual(select_backend('python').name, 'python')
+        self.assertEqual(select_backend('auto').name, 'native' if coincurve else 'python')
+        with self.assertRaises(ValueError):
+            select_backend('openssl')
+
+    @skipUnless(coincurve, 'coincurve is not installed')
+    def test_differential(self):
+        backends = (PythonBackend(), NativeBackend())
+        secrets = (1, 2, 0xdeadbeef, 2**255 + 19, SECP_256K1_N - 1, randint(1, SECP_256K1_N - 1))
+        zs = (0, 1, 2**256 - 1, randint(0, 2**256 - 1))
+        for secret in secrets:
+            for compressed in (True, False):
+                secs = [backend.pubkey(secret, compressed) for backend in backends]
+                self.assertEqual(secs[0], secs[1])
+                points = [backend.parse_sec(secs[0]) for backend in backends]
+                self.assertEqual(points[0], points[1])
+                self.assertEqual([backend.serialize_sec(points[0], compressed) for backend in backends], secs)
+            sec = backends[0].pubkey(secret)
+            for z in zs:
+                sigs = [backend.sign(secret, z) for backend in backends]
+                self.assertEqual(sigs[0].der(), sigs[1].der())
+                high_s = Signature(sigs[0].r, SECP_256K1_N - sigs[0].s)
+                for backend in backends:
+                    self.assertTrue(backend.verify(sec, z, sigs[0]))
+                    self.assertTrue(backend.verify(sec, z, high_s))
+                    self.assertFalse(backend.verify(sec, (z + 1) % 2**256, sigs[0]))
+        for data in (b'', b'hello world', bytes(range(256))):
+            self.assertEqual(backends[0].hash160(data), backends[1].hash160(data))
+            self.assertEqual(backends[0].hash256(data), backends[1].hash256(data))
@@ -5,6 +5,8 @@ class FieldElement:
     """
     Field Element Class
     """
+    __slots__ = ('num', 'prime')
+
     def __init__(self, num, prime):
         if num > prime or num < 0:
             error = 'Num {} not in field range 0 to {}'.format(num, prime - 1)
@@ -0,0 +1,91 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase
+
+from AddressCoder import encode_base58_checksum, hash160
+from S256Point import SECP_256K1_G, SECP_256K1_N, generator_mul, jacobian_add_affine, \
+    jacobian_batch_to_affine, load_generator_table
+
+
+def _address(prefix, sec):
+    return encode_base58_checksum(prefix + hash160(sec))
+
+
+def derive_chunk(start, stop, testnet=False):
+    '''
+    Returns (secret, compressed address, uncompressed address) for every
+    secret in range(start, stop). Only the first key needs a scalar
+    multiplication; the rest are one addition of G each, and the whole
+    chunk is normalized with a single inversion.
+    '''
+    if not 1 <= start <= stop <= SECP_256K1_N:
+        raise ValueError('secrets must be in the range 1 to {}'.format(SECP_256K1_N - 1))
+    gx, gy = SECP_256K1_G.x.num, SECP_256K1_G.y.num
+    current = generator_mul(start)
+    points = []
+    for _ in range(start, stop):
+        points.append(current)
+        current = jacobian_add_affine(current, gx, gy)
+    if testnet:
+        prefix = b'\x6f'
+    else:
+        prefix = b'\x00'
+    result = []
+    for secret, (x, y) in zip(range(start, stop), jacobian_batch_to_affine(points)):
+        x_bin = x.to_bytes(32, 'big')
+        if y % 2 == 0:
+            compressed = b'\x02' + x_bin
+        else:
+            compressed = b'\x03' + x_bin
+        uncompressed = b'\x04' + x_bin + y.to_bytes(32, 'big')
+        result.append((secret, _address(prefix, compressed), _address(prefix, uncompressed)))
+    return result
+
+
+def derive_range(start, stop, testnet=False, chunk_size=4096, max_workers=None, table_file=None):
+    '''
+    Yields (secret, compressed address, uncompressed address) for every
+    secret in range(start, stop), in order. Chunks are derived in a process
+    pool unless max_workers is 1; table_file is a generator table saved with
+    GeneratorTable.save() that the workers map instead of rebuilding it.
+    '''
+    starts = range(start, stop, chunk_size)
+    if max_workers == 1:
+        for chunk_start in starts:
+            yield from derive_chunk(chunk_start, min(chunk_start + chunk_size, stop), testnet)
+        return
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if table_file is None:
+        executor = ProcessPoolExecutor(max_workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers, initializer=load_generator_table, initargs=(table_file,))
+    with executor:
+        # keep a bounded number of chunks in flight so huge ranges stream
+        pending = deque()
+        in_flight = 2 * max_workers
+        for chunk_start in starts:
+            pending.append(executor.submit(
+                derive_chunk, chunk_start, min(chunk_start + chunk_size, stop), testnet))
+            if len(pending) >= in_flight:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class KeyRangeTest(TestCase):
+    def test_derive_chunk(self):
+        for secret, compressed, uncompressed in derive_chunk(1, 40, testnet=True):
+            point = secret * SECP_256K1_G
+            self.assertEqual(compressed, point.address(compressed=True, testnet=True))
+            self.assertEqual(uncompressed, point.address(compressed=False, testnet=True))
+        secret, compressed, uncompressed = derive_chunk(321, 322)[0]
+        self.assertEqual(uncompressed, '1S6g2xBJSED7Qr9CYZib5f4PYVhHZiVfj')
+        with self.assertRaises(ValueError):
+            derive_chunk(0, 10)
+
+    def test_derive_range(self):
+        want = derive_chunk(1000, 1100)
+        self.assertEqual(list(derive_range(1000, 1100, chunk_size=7, max_workers=1)), want)
+        self.assertEqual(list(derive_range(1000, 1100, chunk_size=30, max_workers=2)), want)
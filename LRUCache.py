@@ -0,0 +1,237 @@
+import threading
+from collections import OrderedDict
+from unittest import TestCase
+
+# default of LRUCache.resize: leave maxbytes as it is
+UNCHANGED = object()
+
+
+class LRUCache:
+    '''
+    Thread-safe mapping that evicts the least recently used entry first
+    once it holds more than maxsize entries or, when maxbytes is given,
+    more than maxbytes as measured by sizeof(value). Either limit may be
+    None. Pinned entries are never evicted and do not count against the
+    limits. Lookups through get() are counted as hits or misses.
+    '''
+
+    def __init__(self, maxsize=1024, maxbytes=None, sizeof=None):
+        if maxbytes is not None and sizeof is None:
+            raise ValueError('maxbytes needs a sizeof function')
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.pinned = {}
+        # sizeof of every unpinned entry, and their total
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return 'LRUCache({}/{})'.format(len(self.entries), self.maxsize)
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.pinned
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.pinned:
+                return self.pinned[key]
+            value = self.entries[key]
+            self.entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key in self.pinned:
+                del self.pinned[key]
+            else:
+                del self.entries[key]
+                self.forget(key)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                if key in self.pinned:
+                    self.hits += 1
+                    return self.pinned[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.pinned:
+                self.pinned[key] = value
+                return
+            self.store(key, value)
+
+    def store(self, key, value):
+        # callers hold the lock
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.sizeof is not None:
+            self.forget(key)
+            size = self.sizeof(value)
+            self.sizes[key] = size
+            self.bytes += size
+        self.evict()
+
+    def pin(self, key):
+        '''
+        keeps the entry for key until unpin, raises KeyError when there is
+        none
+        '''
+        with self.lock:
+            if key not in self.pinned:
+                self.pinned[key] = self.entries.pop(key)
+                self.forget(key)
+
+    def unpin(self, key):
+        with self.lock:
+            if key in self.pinned:
+                self.store(key, self.pinned.pop(key))
+
+    def forget(self, key):
+        # callers hold the lock
+        size = self.sizes.pop(key, None)
+        if size is not None:
+            self.bytes -= size
+
+    def evict(self):
+        # callers hold the lock
+        while self.entries and (
+                (self.maxsize is not None and len(self.entries) > self.maxsize)
+                or (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            key, _ = self.entries.popitem(last=False)
+            self.forget(key)
+            self.evictions += 1
+
+    def resize(self, maxsize, maxbytes=UNCHANGED):
+        '''
+        sets new limits and evicts down to them; maxbytes stays as it is
+        unless one is given, None included
+        '''
+        with self.lock:
+            if maxbytes is UNCHANGED:
+                maxbytes = self.maxbytes
+            if maxbytes is not None and self.sizeof is None:
+                raise ValueError('maxbytes needs a sizeof function')
+            self.maxsize = maxsize
+            self.maxbytes = maxbytes
+            self.evict()
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items()) + list(self.pinned.items())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'pinned': len(self.pinned),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(len(cache), 2)
+        cache.resize(1)
+        self.assertEqual([k for k, _ in cache.items()], ['c'])
+
+    def test_stats(self):
+        cache = LRUCache(maxsize=1)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.put('b', 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_maxbytes(self):
+        cache = LRUCache(maxsize=None, maxbytes=10, sizeof=len)
+        cache['a'] = b'1234'
+        cache['b'] = b'1234'
+        cache['a'] = b'12'
+        self.assertEqual(cache.stats()['bytes'], 6)
+        cache['c'] = b'12345'
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats()['bytes'], 7)
+        with self.assertRaises(ValueError):
+            LRUCache(maxbytes=10)
+        # resizing the count keeps the byte limit
+        cache.resize(10)
+        self.assertEqual(cache.maxbytes, 10)
+        cache['d'] = b'12345'
+        self.assertEqual(cache.stats()['bytes'], 10)
+        cache.resize(10, None)
+        self.assertIsNone(cache.maxbytes)
+
+    def test_pin(self):
+        cache = LRUCache(maxsize=1)
+        cache['a'] = 1
+        cache.pin('a')
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(cache.get('a'), 1)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+        cache['a'] = 4
+        self.assertEqual(cache.stats()['pinned'], 1)
+        cache.unpin('a')
+        self.assertEqual([k for k, _ in cache.items()], ['a'])
+        self.assertEqual(cache['a'], 4)
+        with self.assertRaises(KeyError):
+            cache.pin('z')
+
+    def test_unpin_sizes(self):
+        cache = LRUCache(maxsize=None, maxbytes=4, sizeof=len)
+        cache['a'] = b'12'
+        cache.pin('a')
+        self.assertEqual(cache.stats()['bytes'], 0)
+        cache['b'] = b'123'
+        # unpinning counts the entry again and evicts in the same step
+        cache.unpin('a')
+        self.assertEqual(cache.stats()['bytes'], 2)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache['a'], b'12')
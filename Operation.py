@@ -3,52 +3,71 @@ import logging
 import unittest
 
 from Crypto.Hash import SHA256, SHA1, RIPEMD160
+
+import CryptoBackend
 from AddressCoder import hash256, hash160
-from S256Point import S256Point
 from Signature import Signature
+from SignatureCache import SIGNATURE_CACHE
+
+# keys an OP_CHECKMULTISIG may take, and the signature checks it counts
+# for when that number is not known up front
+MAX_PUBKEYS_PER_MULTISIG = 20
 
 
 def encode_num(num):
+    '''
+    encodes an integer the way script numbers are: little endian, as short
+    as possible, with the top bit of the last byte as the sign
+    '''
+    encoded = SMALL_NUMS.get(num)
+    if encoded is not None:
+        return encoded
     if num == 0:
         return b''
     abs_num = abs(num)
-    negative = num < 0
-    result = bytearray()
-    while abs_num:
-        result.append(abs_num & 0xff)
-        abs_num >>= 8
-    # if the top bit is set,
-    # for negative numbers we ensure that the top bit is set
-    # for positive numbers we ensure that the top bit is not set
-    if result[-1] & 0x80:
-        if negative:
-            result.append(0x80)
-        else:
-            result.append(0)
-    elif negative:
-        result[-1] |= 0x80
-    return bytes(result)
-
-
-def decode_num(element):
-    if element == b'':
-        return 0
-    # reverse for big endian
-    big_endian = element[::-1]
-    # top bit being 1 means it's negative
-    if big_endian[0] & 0x80:
-        negative = True
-        result = big_endian[0] & 0x7f
-    else:
-        negative = False
-        result = big_endian[0]
-    for c in big_endian[1:]:
-        result <<= 8
-        result += c
-    if negative:
-        return -result
-    else:
-        return result
+    # one byte more than the magnitude strictly needs whenever its top bit
+    # is taken, so the sign bit always has room
+    length = abs_num.bit_length() // 8 + 1
+    if num < 0:
+        abs_num |= 1 << (length * 8 - 1)
+    return abs_num.to_bytes(length, 'little')
+
+
+def decode_num(element, minimal=False):
+    '''
+    decodes a script number, with minimal set a number that has a shorter
+    encoding raises ValueError
+    '''
+    num = SMALL_NUM_VALUES.get(element)
+    if num is not None:
+        return num
+    if minimal and not is_minimal_num(element):
+        raise ValueError('non-minimally encoded number: {}'.format(element.hex()))
+    num = int.from_bytes(element, 'little')
+    sign = 1 << (len(element) * 8 - 1)
+    if num & sign:
+        return sign - num
+    return num
+
+
+def is_minimal_num(element):
+    '''
+    whether element is the shortest encoding of its number: the last byte
+    may only be 0x00 or 0x80 when the byte before it needs the top bit
+    '''
+    if element and element[-1] & 0x7f == 0:
+        return len(element) > 1 and element[-2] & 0x80 != 0
+    return True
+
+
+# the numbers the interpreter sees most: OP_1NEGATE, OP_0..OP_16 and
+# small counters, encoded once
+SMALL_NUMS = {}
+SMALL_NUM_VALUES = {}
+for n in range(-1, 256):
+    encoded = encode_num(n)
+    SMALL_NUMS[n] = encoded
+    SMALL_NUM_VALUES[encoded] = n
 
 
 def op_0(stack):
@@ -145,78 +164,6 @@ def op_nop(stack):
     return True
 
 
-def op_if(stack, items):
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            # nested if, we have to go another endif
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
-    element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = false_items
-    else:
-        items[:0] = true_items
-    return True
-
-
-def op_notif(stack, items):
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            # nested if, we have to go another endif
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
-    element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = true_items
-    else:
-        items[:0] = false_items
-    return True
-
-
 def op_verify(stack):
     if len(stack) < 1:
         return False
@@ -646,19 +593,77 @@ def op_hash256(stack):
     return True
 
 
+def signature_hash(z, signature):
+    '''
+    z is either the signature hash or a function that returns it for the
+    sighash type of a signature, its last byte
+    '''
+    if callable(z):
+        return z(signature[-1])
+    return z
+
+
+def verify_signature(sec, signature, z):
+    '''
+    Checks a signature as it appears on the stack (DER plus the sighash
+    byte) against a SEC pubkey, consulting SIGNATURE_CACHE first. z is as
+    for signature_hash. Raises ValueError, SyntaxError or IndexError when
+    either of them is malformed.
+    '''
+    z = signature_hash(z, signature)
+    der = signature[:-1]
+    if SIGNATURE_CACHE.contains(z, sec, der):
+        return True
+    sig = Signature.parse(der)
+    if CryptoBackend.BACKEND.verify(sec, z, sig):
+        SIGNATURE_CACHE.add(z, sec, der)
+        return True
+    return False
+
+
+def verify_multisig(secs, signatures, z):
+    '''
+    Checks m stack signatures against n SEC pubkeys; every signature must
+    match a different pubkey, in the same order. Raises like
+    verify_signature when a signature is malformed.
+    '''
+    backend = CryptoBackend.BACKEND
+    zs = [signature_hash(z, signature) for signature in signatures]
+    ders = [signature[:-1] for signature in signatures]
+    sigs = [Signature.parse(der) for der in ders]
+    key_index = 0
+    for i, sig in enumerate(sigs):
+        while True:
+            # if we have no more points, signatures are no good
+            if len(secs) - key_index < len(sigs) - i:
+                logging.info("signatures no good or not in right order")
+                return False
+            sec = secs[key_index]
+            key_index += 1
+            if SIGNATURE_CACHE.contains(zs[i], sec, ders[i]):
+                break
+            try:
+                if backend.verify(sec, zs[i], sig):
+                    SIGNATURE_CACHE.add(zs[i], sec, ders[i])
+                    break
+            except ValueError as e:
+                # an unparsable pubkey simply does not match
+                logging.info(e)
+    return True
+
+
 def op_checksig(stack, z):
     if len(stack) < 2:
         return False
     pubkey_sec = stack.pop()
-    signature_der = stack.pop()[:-1]
+    signature = stack.pop()
     try:
-        point = S256Point.parse(pubkey_sec)
-        sig = Signature.parse(signature_der)
-    except (ValueError, SyntaxError) as e:
+        valid = verify_signature(pubkey_sec, signature, z)
+    except (ValueError, SyntaxError, IndexError) as e:
         logging.info(e)
         return False
 
-    if point.verify(z, sig):
+    if valid:
         stack.append(encode_num(1))
     else:
         stack.append(encode_num(0))
@@ -673,33 +678,27 @@ def op_checkmultisig(stack, z):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
-    if len(stack) < n + 1:
+    if n < 0 or n > MAX_PUBKEYS_PER_MULTISIG or len(stack) < n + 1:
         return False
     sec_pubkeys = []
     for _ in range(n):
         sec_pubkeys.append(stack.pop())
     m = decode_num(stack.pop())
-    if len(stack) < m + 1:
+    if m < 0 or m > n or len(stack) < m + 1:
         return False
-    der_signatures = []
+    signatures = []
     for _ in range(m):
-        der_signatures.append(stack.pop()[:-1])
+        signatures.append(stack.pop())
     stack.pop()
     try:
-        points = [S256Point.parse(sec) for sec in sec_pubkeys]
-        sigs = [Signature.parse(der) for der in der_signatures]
-        for sig in sigs:
-            # if we have no more points, signatures are no good
-            if len(points) == 0:
-                logging.info("signatures no good or not in right order")
-                return False
-            while points:
-                point = points.pop(0)
-                if point.verify(z, sig):
-                    break
-        stack.append(encode_num(1))
-    except (ValueError, SyntaxError):
+        valid = verify_multisig(sec_pubkeys, signatures, z)
+    except (ValueError, SyntaxError, IndexError) as e:
+        logging.info(e)
         return False
+    if valid:
+        stack.append(encode_num(1))
+    else:
+        stack.append(encode_num(0))
     return True
 
 
@@ -742,6 +741,23 @@ def op_checksequenceverify(stack, version, sequence):
     return True
 
 class OperationTest(unittest.TestCase):
+    def test_encode_num(self):
+        cases = ((0, ''), (1, '01'), (-1, '81'), (16, '10'), (127, '7f'), (128, '8000'),
+                 (-128, '8080'), (255, 'ff00'), (256, '0001'), (-255, 'ff80'),
+                 (32767, 'ff7f'), (-32768, '008080'), (2**31 - 1, 'ffffff7f'))
+        for num, encoded in cases:
+            self.assertEqual(encode_num(num).hex(), encoded)
+            self.assertEqual(decode_num(bytes.fromhex(encoded)), num)
+            self.assertEqual(decode_num(bytes.fromhex(encoded), minimal=True), num)
+        for num in range(-70000, 70000, 37):
+            self.assertEqual(decode_num(encode_num(num)), num)
+        # padded and negative zero encodings decode, but are not minimal
+        for encoded, num in (('0100', 1), ('80', 0), ('0080', 0), ('ff0000', 255), ('810080', -129)):
+            self.assertEqual(decode_num(bytes.fromhex(encoded)), num)
+            self.assertFalse(is_minimal_num(bytes.fromhex(encoded)))
+        with self.assertRaises(ValueError):
+            decode_num(b'\x01\x00', minimal=True)
+
     def test_op_hash160(self):
         stack = [b'hello world']
         self.assertTrue(op_hash160(stack))
@@ -754,6 +770,42 @@ class OperationTest(unittest.TestCase):
         stack = [sig, sec]
         self.assertTrue(op_checksig(stack, z))
         self.assertEqual(decode_num(stack[0]), 1)
+        stack = [sig, sec]
+        self.assertTrue(op_checksig(stack, z + 1))
+        self.assertEqual(decode_num(stack[0]), 0)
+
+    def test_signature_cache(self):
+        z = 0x7c076ff316692a3d7eb3c3bb0f8b1488cf72e1afcd929e29307032997a838a3d
+        sec = bytes.fromhex('04887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c61de6d95231cd89026e286df3b6ae4a894a3378e393e93a0f45b666329a0ae34')
+        sig = bytes.fromhex('3045022000eff69ef2b1bd93a66ed5219add4fb51e11a840f404876325a1e8ffe0529a2c022100c7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab601')
+        SIGNATURE_CACHE.clear()
+        self.assertTrue(verify_signature(sec, sig, z))
+        self.assertTrue(SIGNATURE_CACHE.contains(z, sec, sig[:-1]))
+        self.assertTrue(verify_signature(sec, sig, z))
+        self.assertFalse(verify_signature(sec, sig, z + 1))
+        self.assertFalse(SIGNATURE_CACHE.contains(z + 1, sec, sig[:-1]))
+        # an off-curve key sharing x and the parity of y is not a cache hit
+        y = int.from_bytes(sec[33:], 'big') + 2
+        fake = sec[:33] + y.to_bytes(32, 'big')
+        with self.assertRaises(ValueError):
+            verify_signature(fake, sig, z)
+
+    def test_op_checkmultisig(self):
+        z = 0xe71bfa115715d6fd33796948126f40a8cdd39f187e4afb03896795189fe1423c
+        sig1 = bytes.fromhex('3045022100dc92655fe37036f47756db8102e0d7d5e28b3beb83a8fef4f5dc0559bddfb94e02205a36d4e4e6c7fcd16658c50783e00c341609977aed3ad00937bf4ee942a8993701')
+        sig2 = bytes.fromhex('3045022100da6bee3c93766232079a01639d07fa869598749729ae323eab8eef53577d611b02207bef15429dcadce2121ea07f233115c6f09034c0be68db99980b9a6c5e75402201')
+        sec1 = bytes.fromhex('022626e955ea6ea6d98850c994f9107b036b1334f18ca8830bfff1295d21cfdb70')
+        sec2 = bytes.fromhex('03b287eaf122eea69030a0e9feed096bed8045c8b98bec453e1ffac7fbdbd4bb71')
+        stack = [b'', sig1, sig2, b'\x02', sec1, sec2, b'\x02']
+        self.assertTrue(op_checkmultisig(stack, z))
+        self.assertEqual(decode_num(stack[0]), 1)
+        # signatures out of order
+        stack = [b'', sig2, sig1, b'\x02', sec1, sec2, b'\x02']
+        self.assertTrue(op_checkmultisig(stack, z))
+        self.assertEqual(decode_num(stack[0]), 0)
+        stack = [b'', sig1, sig2, b'\x02', sec1, sec2, b'\x02']
+        self.assertTrue(op_checkmultisig(stack, z + 1))
+        self.assertEqual(decode_num(stack[0]), 0)
 
 
 OP_CODE_FUNCTIONS = {
@@ -776,8 +828,6 @@ OP_CODE_FUNCTIONS = {
     95: op_15,
     96: op_16,
     97: op_nop,
-    99: op_if,
-    100: op_notif,
     105: op_verify,
     106: op_return,
     107: op_toaltstack,
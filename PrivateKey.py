@@ -1,10 +1,19 @@
 import hashlib
 import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor
 from random import randint
 from unittest import TestCase
 
 from AddressCoder import encode_base58_checksum
-from S256Point import SECP_256K1_G, SECP_256K1_N, Signature
+from S256Point import SECP_256K1_G, SECP_256K1_N, Signature, generator_mul, jacobian_batch_to_affine
+
+
+def sign_chunk(secret, zs):
+    '''
+    signs a chunk of hashes in a worker process for PrivateKey.sign_many
+    '''
+    return PrivateKey(secret).sign_many(zs, max_workers=1)
 
 
 class PrivateKey:
@@ -12,42 +21,68 @@ class PrivateKey:
     def __init__(self, secret):
         self.secret = secret
         self.point = secret * SECP_256K1_G
+        self.k_hmac = None
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
     def sign(self, z):
-        k = self.deterministic_k(z)
-        r = (k * SECP_256K1_G).x.num
-        k_inv = pow(k, (SECP_256K1_N - 2), SECP_256K1_N)
-        s = (z + r * self.secret) * k_inv % SECP_256K1_N
-        if s > SECP_256K1_N / 2:
-            s = SECP_256K1_N - s
-        return Signature(r, s)
+        return self.sign_many([z], max_workers=1)[0]
+
+    def sign_many(self, zs, max_workers=1, chunk_size=64):
+        '''
+        Signs every hash in zs and returns the signatures in order, exactly
+        as sign() would. All the nonce points k * G are normalized together
+        with one inversion; with max_workers other than 1 the hashes are
+        split into chunks signed in a process pool.
+        '''
+        zs = list(zs)
+        if max_workers != 1 and len(zs) > chunk_size:
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            chunks = [zs[i:i + chunk_size] for i in range(0, len(zs), chunk_size)]
+            with ProcessPoolExecutor(min(max_workers, len(chunks))) as executor:
+                results = executor.map(sign_chunk, [self.secret] * len(chunks), chunks)
+                return [sig for chunk in results for sig in chunk]
+        ks = [self.deterministic_k(z) for z in zs]
+        nonce_points = jacobian_batch_to_affine([generator_mul(k) for k in ks])
+        sigs = []
+        for z, k, (r, _) in zip(zs, ks, nonce_points):
+            k_inv = pow(k, -1, SECP_256K1_N)
+            s = (z + r * self.secret) * k_inv % SECP_256K1_N
+            # low-S: use the smaller of s and N - s
+            if s > SECP_256K1_N // 2:
+                s = SECP_256K1_N - s
+            sigs.append(Signature(r, s))
+        return sigs
 
     def deterministic_k(self, z):
         """
         RFC 6979
         IMPORTANT: every signature must has a deterministic unique k.
         """
-        k = b'\x00' * 32
         v = b'\x01' * 32
         if z > SECP_256K1_N:
             z -= SECP_256K1_N
         z_bytes = z.to_bytes(32, 'big')
         secret_bytes = self.secret.to_bytes(32, 'big')
-        s256 = hashlib.sha256
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
+        if self.k_hmac is None:
+            # the first round always keys HMAC with zeros and starts with
+            # V || 0x00 || secret, so that state is set up once per key
+            self.k_hmac = hmac.new(b'\x00' * 32, v + b'\x00' + secret_bytes, hashlib.sha256)
+        first = self.k_hmac.copy()
+        first.update(z_bytes)
+        k = first.digest()
+        v = hmac.digest(k, v, 'sha256')
+        k = hmac.digest(k, v + b'\x01' + secret_bytes + z_bytes, 'sha256')
+        v = hmac.digest(k, v, 'sha256')
         while True:
-            v = hmac.new(k, v, s256).digest()
+            v = hmac.digest(k, v, 'sha256')
             candidate = int.from_bytes(v, 'big')
             if 1 <= candidate < SECP_256K1_N:
                 return candidate
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+            k = hmac.digest(k, v + b'\x00', 'sha256')
+            v = hmac.digest(k, v, 'sha256')
 
     def wif(self, compressed=True, testnet=False):
         secret_bytes = self.secret.to_bytes(32, 'big')
@@ -70,6 +105,25 @@ class PrivateKeyTest(TestCase):
         sig = pk.sign(z)
         self.assertTrue(pk.point.verify(z, sig))
 
+    def test_sign_many(self):
+        pk = PrivateKey(0xdeadbeef12345)
+        zs = [randint(0, 2**256) for _ in range(6)] + [SECP_256K1_N + 5]
+        sigs = pk.sign_many(zs)
+        self.assertEqual(len(sigs), len(zs))
+        for z, sig in zip(zs, sigs):
+            self.assertTrue(pk.point.verify(z, sig))
+            self.assertTrue(sig.s <= SECP_256K1_N // 2)
+            self.assertEqual(sig.der(), pk.sign(z).der())
+        parallel = pk.sign_many(zs, max_workers=2, chunk_size=2)
+        self.assertEqual([sig.der() for sig in parallel], [sig.der() for sig in sigs])
+
+    def test_deterministic_k(self):
+        # RFC 6979 A.2.5-style vector for secp256k1 (secret 1, sha256('Satoshi Nakamoto'))
+        pk = PrivateKey(1)
+        z = int.from_bytes(hashlib.sha256(b'Satoshi Nakamoto').digest(), 'big')
+        want = 0x8F8A276C19F4149656B280621E358CCE24F5F52542772691EE69063B74F15D15
+        self.assertEqual(pk.deterministic_k(z), want)
+
     def test_wif(self):
         pk = PrivateKey(2**256 - 2**199)
         expected = 'L5oLkpV3aqBJ4BgssVAsax1iRa77G5CVYnv9adQ6Z87te7TyUdSC'
@@ -1,18 +1,141 @@
+from unittest import TestCase
+
 from FieldElement import FieldElement
 
 SECP_256K1_P = 2 ** 256 - 2 ** 32 - 977
 
+
 class S256Field(FieldElement):
+    '''
+    FieldElement specialised for the secp256k1 prime. The prime is a class
+    constant, so operations skip the prime comparisons and build their
+    results without re-running the range check in __init__.
+    '''
+    __slots__ = ()
+    prime = SECP_256K1_P
+
     def __init__(self, num, prime=None):
-        super().__init__(num=num, prime=SECP_256K1_P)
+        if not 0 <= num < SECP_256K1_P:
+            error = 'Num {} not in field range 0 to {}'.format(num, SECP_256K1_P - 1)
+            raise ValueError(error)
+        self.num = num
+
+    def __reduce__(self):
+        # the inherited 'prime' slot is shadowed by the class constant, so
+        # the default slot state cannot be restored
+        return (S256Field, (self.num,))
 
     def __repr__(self):
         return '{:x}'.format(self.num).zfill(64)
 
+    def __eq__(self, other):
+        if other is None:
+            return False
+        if other.__class__ is S256Field:
+            return self.num == other.num
+        return super().__eq__(other)
+
+    def __add__(self, other):
+        return s256_field((self.num + other.num) % SECP_256K1_P)
+
+    def __sub__(self, other):
+        return s256_field((self.num - other.num) % SECP_256K1_P)
+
+    def __mul__(self, other):
+        if type(other) == int:
+            return s256_field(self.num * other % SECP_256K1_P)
+        return s256_field(self.num * other.num % SECP_256K1_P)
+
+    def __rmul__(self, coefficient):
+        return s256_field(self.num * coefficient % SECP_256K1_P)
+
+    def __pow__(self, exponent):
+        if exponent == -1:
+            return self.inverse()
+        return s256_field(pow(self.num, exponent % (SECP_256K1_P - 1), SECP_256K1_P))
+
+    def __truediv__(self, other):
+        return s256_field(self.num * s256_inverse(other.num) % SECP_256K1_P)
+
+    def inverse(self):
+        return s256_field(s256_inverse(self.num))
+
     def sqrt(self):
-        return self ** (( SECP_256K1_P + 1) // 4)
+        return s256_field(s256_sqrt(self.num))
+
+
+def s256_inverse(num):
+    '''
+    returns num^-1 mod P, and like num^(P-2), the Fermat inverse
+    FieldElement uses, 0 for 0
+    '''
+    if num == 0:
+        return 0
+    return pow(num, -1, SECP_256K1_P)
+
+
+def s256_field(num):
+    '''
+    builds an S256Field from an already reduced int without validation
+    '''
+    element = object.__new__(S256Field)
+    element.num = num
+    return element
+
+
+def s256_sqrt(num):
+    '''
+    returns a square root of num mod P on plain ints; P = 3 mod 4, so this
+    is a single exponentiation (the caller checks whether it squares back)
+    '''
+    return pow(num, (SECP_256K1_P + 1) // 4, SECP_256K1_P)
+
+
+class S256FieldTest(TestCase):
+    def test_ops(self):
+        a = S256Field(SECP_256K1_P - 1)
+        b = S256Field(5)
+        self.assertEqual(a + b, S256Field(4))
+        self.assertEqual(b - a, S256Field(6))
+        self.assertEqual(a * b, S256Field(SECP_256K1_P - 5))
+        self.assertEqual(3 * b, S256Field(15))
+        self.assertEqual(b ** 2, S256Field(25))
+        self.assertEqual(b / b, S256Field(1))
+        self.assertEqual(b ** -1 * b, S256Field(1))
+        self.assertEqual(b.inverse(), b ** (SECP_256K1_P - 2))
+        # zero has no inverse; as with FieldElement, dividing by it gives 0
+        zero = S256Field(0)
+        self.assertEqual(zero.inverse(), S256Field(0))
+        self.assertEqual(zero ** -1, FieldElement(0, SECP_256K1_P) ** -1)
+        self.assertEqual(b / zero, FieldElement(5, SECP_256K1_P) / FieldElement(0, SECP_256K1_P))
+        self.assertEqual(S256Field(25).sqrt() ** 2, S256Field(25))
+        self.assertEqual(b, FieldElement(5, SECP_256K1_P))
+
+    def test_range(self):
+        with self.assertRaises(ValueError):
+            S256Field(SECP_256K1_P)
+        with self.assertRaises(ValueError):
+            S256Field(-1)
+
+    def test_pickle(self):
+        import copy
+        import pickle
+        from PrivateKey import PrivateKey
+        from S256Point import SECP_256K1_G
+        a = S256Field(5)
+        for element in (pickle.loads(pickle.dumps(a)), copy.copy(a), copy.deepcopy(a)):
+            self.assertIs(type(element), S256Field)
+            self.assertEqual(element, a)
+        point = 12345 * SECP_256K1_G
+        self.assertEqual(pickle.loads(pickle.dumps(point)), point)
+        self.assertEqual(copy.deepcopy(point), point)
+        private_key = PrivateKey(secret=8675309)
+        self.assertEqual(pickle.loads(pickle.dumps(private_key)).point, private_key.point)
 
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            S256Field(1).extra = 1
 
 
 if __name__ == '__main__':
-    print(S256Field(12))
\ No newline at end of file
+    print(S256Field(12))
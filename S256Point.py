@@ -1,21 +1,413 @@
+import mmap
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from unittest import TestCase
 
 from AddressCoder import hash160, encode_base58_checksum
+from LRUCache import LRUCache
 from Point import  Point
-from S256Field import S256Field, SECP_256K1_P
+from S256Field import S256Field, SECP_256K1_P, s256_field, s256_sqrt
 from Signature import Signature
+from SignatureCache import SIGNATURE_CACHE
 
 SECP_256K1_A = 0
 SECP_256K1_B = 7
+SECP_256K1_A_FIELD = S256Field(SECP_256K1_A)
+SECP_256K1_B_FIELD = S256Field(SECP_256K1_B)
+# number of parsed SEC pubkeys S256Point.parse keeps around
+SEC_CACHE_SIZE = 4096
 SECP_256K1_N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
+# GLV endomorphism: (x, y) -> (beta * x, y) is the same as multiplying by
+# lambda, since beta and lambda are cube roots of unity mod P and mod N.
+SECP_256K1_BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+SECP_256K1_LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+# short basis of the lattice {(a, b): a + b * lambda = 0 mod N}
+GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+GLV_B2 = 0x3086d221a7d46bcde86c90e49284eb15
+
+
+def glv_split(coefficient):
+    '''
+    returns (k1, k2), both about 128 bits and possibly negative, with
+    k1 + k2 * lambda = coefficient mod N
+    '''
+    half = SECP_256K1_N >> 1
+    c1 = (GLV_B2 * coefficient + half) // SECP_256K1_N
+    c2 = (-GLV_B1 * coefficient + half) // SECP_256K1_N
+    k1 = coefficient - c1 * GLV_A1 - c2 * GLV_A2
+    k2 = -c1 * GLV_B1 - c2 * GLV_B2
+    return k1, k2
+
+
+# Jacobian coordinates on plain ints: (X, Y, Z) stands for the affine point
+# (X / Z^2, Y / Z^3), and any tuple with Z == 0 is the point at infinity.
+# Adding and doubling need no field inversion, so a whole scalar
+# multiplication costs a single inversion when converting back to affine.
+JACOBIAN_INFINITY = (1, 1, 0)
+
+
+def jacobian_double(p):
+    x1, y1, z1 = p
+    if z1 == 0 or y1 == 0:
+        return JACOBIAN_INFINITY
+    # dbl-2009-l, specialised for a = 0
+    a = x1 * x1 % SECP_256K1_P
+    b = y1 * y1 % SECP_256K1_P
+    c = b * b % SECP_256K1_P
+    d = 2 * ((x1 + b) ** 2 - a - c) % SECP_256K1_P
+    e = 3 * a % SECP_256K1_P
+    x3 = (e * e - 2 * d) % SECP_256K1_P
+    y3 = (e * (d - x3) - 8 * c) % SECP_256K1_P
+    z3 = 2 * y1 * z1 % SECP_256K1_P
+    return x3, y3, z3
+
+
+def jacobian_add(p, q):
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    if z1 == 0:
+        return q
+    if z2 == 0:
+        return p
+    # add-2007-bl
+    z1z1 = z1 * z1 % SECP_256K1_P
+    z2z2 = z2 * z2 % SECP_256K1_P
+    u1 = x1 * z2z2 % SECP_256K1_P
+    u2 = x2 * z1z1 % SECP_256K1_P
+    s1 = y1 * z2 * z2z2 % SECP_256K1_P
+    s2 = y2 * z1 * z1z1 % SECP_256K1_P
+    h = (u2 - u1) % SECP_256K1_P
+    r = (s2 - s1) % SECP_256K1_P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return JACOBIAN_INFINITY
+    hh = h * h % SECP_256K1_P
+    hhh = h * hh % SECP_256K1_P
+    v = u1 * hh % SECP_256K1_P
+    x3 = (r * r - hhh - 2 * v) % SECP_256K1_P
+    y3 = (r * (v - x3) - s1 * hhh) % SECP_256K1_P
+    z3 = z1 * z2 * h % SECP_256K1_P
+    return x3, y3, z3
+
+
+def jacobian_add_affine(p, x2, y2):
+    '''
+    Mixed addition of a Jacobian point and an affine point (Z2 == 1).
+    '''
+    x1, y1, z1 = p
+    if z1 == 0:
+        return x2, y2, 1
+    z1z1 = z1 * z1 % SECP_256K1_P
+    u2 = x2 * z1z1 % SECP_256K1_P
+    s2 = y2 * z1 * z1z1 % SECP_256K1_P
+    h = (u2 - x1) % SECP_256K1_P
+    r = (s2 - y1) % SECP_256K1_P
+    if h == 0:
+        if r == 0:
+            return jacobian_double(p)
+        return JACOBIAN_INFINITY
+    hh = h * h % SECP_256K1_P
+    hhh = h * hh % SECP_256K1_P
+    v = x1 * hh % SECP_256K1_P
+    x3 = (r * r - hhh - 2 * v) % SECP_256K1_P
+    y3 = (r * (v - x3) - y1 * hhh) % SECP_256K1_P
+    z3 = z1 * h % SECP_256K1_P
+    return x3, y3, z3
+
+
+def jacobian_to_affine(p):
+    '''
+    Returns (x, y) as ints, or None for the point at infinity.
+    '''
+    x, y, z = p
+    if z == 0:
+        return None
+    z_inv = pow(z, -1, SECP_256K1_P)
+    z_inv2 = z_inv * z_inv % SECP_256K1_P
+    return x * z_inv2 % SECP_256K1_P, y * z_inv2 * z_inv % SECP_256K1_P
+
+
+def jacobian_batch_to_affine(points):
+    '''
+    Converts many Jacobian points to affine (x, y) ints with Montgomery's
+    trick: one inversion plus about 3 multiplications per point. Points at
+    infinity come back as None.
+    '''
+    # prefix[i] is the product of the non-zero Z values before point i
+    prefix = []
+    product = 1
+    for _, _, z in points:
+        prefix.append(product)
+        if z:
+            product = product * z % SECP_256K1_P
+    inverse = pow(product, -1, SECP_256K1_P)
+    result = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        x, y, z = points[i]
+        if z == 0:
+            continue
+        # inverse is 1 / (z_0 * ... * z_i) here
+        z_inv = inverse * prefix[i] % SECP_256K1_P
+        inverse = inverse * z % SECP_256K1_P
+        z_inv2 = z_inv * z_inv % SECP_256K1_P
+        result[i] = (x * z_inv2 % SECP_256K1_P, y * z_inv2 * z_inv % SECP_256K1_P)
+    return result
+
+
+def jacobian_mul(coefficient, x, y):
+    '''
+    Left-to-right double-and-add of the affine point (x, y).
+    '''
+    result = JACOBIAN_INFINITY
+    for bit in bin(coefficient)[2:]:
+        result = jacobian_double(result)
+        if bit == '1':
+            result = jacobian_add_affine(result, x, y)
+    return result
+
+
+def wnaf(coefficient, width):
+    '''
+    returns the width-w non-adjacent form of coefficient, least
+    significant digit first; every non-zero digit is odd and below
+    2^(w-1) in absolute value
+    '''
+    digits = []
+    window = 1 << width
+    half = window >> 1
+    while coefficient:
+        if coefficient & 1:
+            digit = coefficient & (window - 1)
+            if digit >= half:
+                digit -= window
+            coefficient -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        coefficient >>= 1
+    return digits
+
+
+WNAF_WIDTH = 5
+
+
+def jacobian_odd_multiples(p, width=WNAF_WIDTH):
+    '''
+    returns [P, 3P, 5P, ..., (2^(w-1) - 1)P] as Jacobian tuples
+    '''
+    double = jacobian_double(p)
+    multiples = [p]
+    for _ in range((1 << (width - 2)) - 1):
+        multiples.append(jacobian_add(multiples[-1], double))
+    return multiples
+
+
+def affine_negate(multiples):
+    return [(x, SECP_256K1_P - y) for x, y in multiples]
+
+
+def affine_endomorphism(multiples):
+    return [(SECP_256K1_BETA * x % SECP_256K1_P, y) for x, y in multiples]
+
+
+def jacobian_multi_mul(pairs, glv=False):
+    '''
+    returns sum(k * P) over the (k, P) pairs as a Jacobian tuple, where
+    each P is an affine S256Point. Multiples of G go through the fixed-base
+    table; the other points share one chain of doublings by interleaving
+    their wNAF digits (Strauss-Shamir). With glv, each of those scalars is
+    first split into two ~128-bit halves over P and lambda * P, which
+    halves the doublings.
+    '''
+    result = JACOBIAN_INFINITY
+    generator_coefficient = 0
+    scalars = []
+    tables = []
+    for coefficient, point in pairs:
+        coefficient %= SECP_256K1_N
+        if coefficient == 0 or point.x is None:
+            continue
+        if point.is_generator():
+            generator_coefficient += coefficient
+            continue
+        scalars.append(coefficient)
+        tables.extend(jacobian_odd_multiples(point.to_jacobian()))
+    # normalise every table with one shared inversion so that the main
+    # loop can use the cheaper mixed additions
+    affine = jacobian_batch_to_affine(tables)
+    size = 1 << (WNAF_WIDTH - 2)
+    expansions = []
+    for i, coefficient in enumerate(scalars):
+        multiples = affine[i * size:(i + 1) * size]
+        if not glv:
+            expansions.append((wnaf(coefficient, WNAF_WIDTH), multiples))
+            continue
+        k1, k2 = glv_split(coefficient)
+        for k, table in ((k1, multiples), (k2, affine_endomorphism(multiples))):
+            if k < 0:
+                k, table = -k, affine_negate(table)
+            expansions.append((wnaf(k, WNAF_WIDTH), table))
+    length = max((len(digits) for digits, _ in expansions), default=0)
+    for i in range(length - 1, -1, -1):
+        result = jacobian_double(result)
+        for digits, multiples in expansions:
+            if i >= len(digits):
+                continue
+            digit = digits[i]
+            if digit > 0:
+                x, y = multiples[digit >> 1]
+                result = jacobian_add_affine(result, x, y)
+            elif digit < 0:
+                x, y = multiples[-digit >> 1]
+                result = jacobian_add_affine(result, x, SECP_256K1_P - y)
+    if generator_coefficient:
+        result = jacobian_add(result, generator_mul(generator_coefficient))
+    return result
+
+
+class GeneratorTable:
+    '''
+    Fixed-base window table for G: entry (i, j) holds j * 2^(8i) * G in
+    affine form, so k * G is at most 32 mixed additions and no doublings.
+    The entries are packed as 64-byte big-endian (x, y) records, which lets
+    a saved table be memory-mapped straight from disk.
+    '''
+    WINDOW = 8
+    ROWS = 32
+    COLS = (1 << WINDOW) - 1
+    RECORD_SIZE = 64
+    SIZE = ROWS * COLS * RECORD_SIZE
+
+    def __init__(self, data):
+        if len(data) != self.SIZE:
+            raise ValueError('generator table must be {} bytes, got {}'.format(self.SIZE, len(data)))
+        self.data = data
+
+    @classmethod
+    def build(cls):
+        points = []
+        base = SECP_256K1_G.to_jacobian()
+        for _ in range(cls.ROWS):
+            current = base
+            for _ in range(cls.COLS):
+                points.append(current)
+                current = jacobian_add(current, base)
+            # current is now 2^WINDOW * base, the base of the next row
+            base = current
+        data = bytearray()
+        for x, y in jacobian_batch_to_affine(points):
+            data += x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+        return cls(bytes(data))
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        memory-maps a table written by save()
+        '''
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = cls(data)
+        if table.entry(0, 1) != (SECP_256K1_G.x.num, SECP_256K1_G.y.num):
+            raise ValueError('{} is not a generator table'.format(filename))
+        return table
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.data)
+
+    def entry(self, row, multiple):
+        offset = (row * self.COLS + multiple - 1) * self.RECORD_SIZE
+        return (int.from_bytes(self.data[offset:offset + 32], 'big'),
+                int.from_bytes(self.data[offset + 32:offset + 64], 'big'))
+
+    def multiply(self, coefficient):
+        '''
+        returns coefficient * G as a Jacobian int tuple
+        '''
+        # the table only has rows for scalars below 2^256
+        coefficient %= SECP_256K1_N
+        result = JACOBIAN_INFINITY
+        mask = self.COLS
+        row = 0
+        while coefficient:
+            multiple = coefficient & mask
+            if multiple:
+                x, y = self.entry(row, multiple)
+                result = jacobian_add_affine(result, x, y)
+            coefficient >>= self.WINDOW
+            row += 1
+        return result
+
+
+_generator_table = None
+
+
+def generator_table():
+    '''
+    returns the shared GeneratorTable, building it on first use
+    '''
+    global _generator_table
+    if _generator_table is None:
+        _generator_table = GeneratorTable.build()
+    return _generator_table
+
+
+def load_generator_table(filename):
+    '''
+    makes a table saved with GeneratorTable.save() the shared one, so worker
+    processes can map it instead of rebuilding it
+    '''
+    global _generator_table
+    _generator_table = GeneratorTable.load(filename)
+    return _generator_table
+
+
+def generator_mul(coefficient):
+    '''
+    returns coefficient * G as a Jacobian int tuple
+    '''
+    return generator_table().multiply(coefficient)
+
+
+def verify_chunk(chunk):
+    '''
+    verifies (x, y, z, r, s) int tuples; this is what verify_batch ships to
+    worker processes, since plain ints pickle far cheaper than points
+    '''
+    return [S256Point(x, y).verify(z, Signature(r, s)) for x, y, z, r, s in chunk]
+
+
 class S256Point(Point):
-    def __init__(self, x, y, a = None, b=None):
-        a, b = S256Field(SECP_256K1_A), S256Field(SECP_256K1_B)
+    # split scalars with the GLV endomorphism when multiplying arbitrary points
+    use_glv = True
+    # SEC bytes -> S256Point; resize with S256Point.parse_cache.resize(n)
+    parse_cache = LRUCache(SEC_CACHE_SIZE)
+    # process pools of verify_batch by worker count, see shared_executor
+    executors = {}
+    executor_lock = threading.Lock()
+
+    def __init__(self, x, y, a=None, b=None):
         if type(x) == int:
-            super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
-        else:
-            super().__init__(x=x, y=y, a=a, b=b)
+            x, y = S256Field(x), S256Field(y)
+        # points are immutable, as parse hands the same one to every caller
+        self.__dict__.update(a=SECP_256K1_A_FIELD, b=SECP_256K1_B_FIELD, x=x, y=y)
+        if x is None or y is None:
+            return
+        # curve check on plain ints rather than through field operations
+        if (y.num * y.num - x.num ** 3 - SECP_256K1_B) % SECP_256K1_P:
+            raise ValueError('({} {}) is not on the curve'.format(x, y))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('S256Point is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('S256Point is immutable')
 
     def __repr__(self):
         if self.x is None:
@@ -25,14 +417,156 @@ class S256Point(Point):
 
     def __rmul__(self, coefficient):
         coef = coefficient % SECP_256K1_N
-        return super().__rmul__(coef)
+        if self.x is None or coef == 0:
+            return self.__class__(None, None)
+        if self.is_generator():
+            return self.from_jacobian(generator_table().multiply(coef))
+        return self.from_jacobian(jacobian_multi_mul([(coef, self)], self.use_glv))
+
+    def is_generator(self):
+        return self.x is not None and self.x.num == SECP_256K1_G.x.num \
+            and self.y.num == SECP_256K1_G.y.num
+
+    @classmethod
+    def from_jacobian(cls, p):
+        '''
+        returns the affine S256Point for a Jacobian (X, Y, Z) int tuple
+        '''
+        return cls.normalize_batch([p])[0]
+
+    @classmethod
+    def multi_mul(cls, pairs):
+        '''
+        returns sum(k * P) for a list of (k, P) pairs, sharing the doublings
+        '''
+        return cls.from_jacobian(jacobian_multi_mul(pairs, cls.use_glv))
+
+    @classmethod
+    def normalize_batch(cls, points):
+        '''
+        returns affine S256Points for a list of Jacobian int tuples using a
+        single field inversion for the whole batch
+        '''
+        result = []
+        for affine in jacobian_batch_to_affine(points):
+            if affine is None:
+                result.append(cls(None, None))
+                continue
+            # results of the curve arithmetic are on the curve by construction
+            point = object.__new__(cls)
+            point.__dict__.update(a=SECP_256K1_A_FIELD, b=SECP_256K1_B_FIELD,
+                                  x=s256_field(affine[0]), y=s256_field(affine[1]))
+            result.append(point)
+        return result
+
+    def to_jacobian(self):
+        if self.x is None:
+            return JACOBIAN_INFINITY
+        return self.x.num, self.y.num, 1
 
     def verify(self, z, sig):
+        if self.x is None:
+            return False
         s_inv = pow(sig.s, SECP_256K1_N - 2, SECP_256K1_N)
         u = z * s_inv % SECP_256K1_N
         v = sig.r * s_inv % SECP_256K1_N
-        total = u * SECP_256K1_G + v * self
-        return total.x.num == sig.r
+        total = jacobian_multi_mul([(u, SECP_256K1_G), (v, self)], self.use_glv)
+        affine = jacobian_to_affine(total)
+        if affine is None:
+            return False
+        return affine[0] == sig.r
+
+    @classmethod
+    def verify_batch(cls, items, max_workers=None, chunk_size=None, fail_fast=False, executor=None):
+        '''
+        Verifies a list of (point, z, sig) items across a process pool.
+        Returns a list of booleans, one per item, or with fail_fast a single
+        boolean that is False as soon as any signature fails, without
+        waiting for the remaining chunks. Items already in SIGNATURE_CACHE
+        are not sent to the workers, and a pubkey at infinity fails its
+        item. The work goes to executor when one is given, otherwise to a
+        pool kept for later calls.
+        '''
+        results = [None] * len(items)
+        keys = [None] * len(items)
+        pending = []
+        for i, (point, z, sig) in enumerate(items):
+            if point.x is None:
+                results[i] = False
+                continue
+            try:
+                keys[i] = (z, point.sec(), sig.der())
+            except (IndexError, OverflowError):
+                # r or s der() cannot encode, which verify rejects anyway
+                pass
+            if keys[i] is not None and SIGNATURE_CACHE.contains(*keys[i]):
+                results[i] = True
+            else:
+                pending.append(i)
+        if fail_fast and False in results:
+            return False
+        verified = cls.verify_uncached([items[i] for i in pending], max_workers, chunk_size, fail_fast, executor)
+        if fail_fast:
+            if verified:
+                for i in pending:
+                    if keys[i] is not None:
+                        SIGNATURE_CACHE.add(*keys[i])
+            return verified
+        for i, valid in zip(pending, verified):
+            results[i] = valid
+            if valid and keys[i] is not None:
+                SIGNATURE_CACHE.add(*keys[i])
+        return results
+
+    @classmethod
+    def verify_uncached(cls, items, max_workers=None, chunk_size=None, fail_fast=False, executor=None):
+        work = [(point.x.num, point.y.num, z, sig.r, sig.s) for point, z, sig in items]
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if chunk_size is None:
+            # a few chunks per worker balances the load while keeping the
+            # number of pickled messages small
+            chunk_size = max(16, -(-len(work) // (4 * max_workers)))
+        chunks = [work[i:i + chunk_size] for i in range(0, len(work), chunk_size)]
+        if max_workers == 1 or len(chunks) < 2:
+            results = []
+            for chunk in chunks:
+                chunk_results = verify_chunk(chunk)
+                if fail_fast and not all(chunk_results):
+                    return False
+                results.extend(chunk_results)
+            return all(results) if fail_fast else results
+        if executor is None:
+            executor = cls.shared_executor(max_workers)
+        futures = [executor.submit(verify_chunk, chunk) for chunk in chunks]
+        try:
+            if fail_fast:
+                for future in as_completed(futures):
+                    if not all(future.result()):
+                        return False
+                return True
+            results = []
+            for future in futures:
+                results.extend(future.result())
+            return results
+        finally:
+            # the pool outlives the call, so chunks nobody waits for are
+            # dropped rather than left queued
+            for future in futures:
+                future.cancel()
+
+    @classmethod
+    def shared_executor(cls, max_workers):
+        '''
+        returns the process pool with max_workers workers that verify_batch
+        reuses between calls; pools are never replaced, so a call asking for
+        another size cannot cancel work other threads wait on
+        '''
+        with cls.executor_lock:
+            executor = cls.executors.get(max_workers)
+            if executor is None:
+                executor = cls.executors[max_workers] = ProcessPoolExecutor(max_workers)
+            return executor
 
     def sec(self, compressed=True):
         '''
@@ -48,30 +582,37 @@ class S256Point(Point):
                 self.y.num.to_bytes(32, 'big')
 
     @classmethod
-    def parse(self, sec_bin):
+    def parse(cls, sec_bin):
         '''
         returns a Point object from a SEC binary (not hex)
+
+        Points come from parse_cache, so the same hot pubkey does its
+        square root only once. The returned instances are shared between
+        callers, which S256Point being immutable makes safe.
         '''
+        key = bytes(sec_bin)
+        point = cls.parse_cache.get(key)
+        if point is None:
+            point = cls.parse_uncached(key)
+            cls.parse_cache.put(key, point)
+        return point
+
+    @classmethod
+    def parse_uncached(self, sec_bin):
         if sec_bin[0] == 4:
             x = int.from_bytes(sec_bin[1:33], 'big')
             y = int.from_bytes(sec_bin[33:65], 'big')
             return S256Point(x=x, y=y)
         is_even = sec_bin[0] == 2
-        x = S256Field(int.from_bytes(sec_bin[1:], 'big'))
+        x = int.from_bytes(sec_bin[1:], 'big')
         # right side of the equation y^2 = x^3 + 7
-        alpha = x ** 3 + S256Field(SECP_256K1_B)
-        # solve for left side
-        beta = alpha.sqrt()
-        if beta.num % 2 == 0:
-            even_beta = beta
-            odd_beta = S256Field(SECP_256K1_P - beta.num)
+        alpha = (pow(x, 3, SECP_256K1_P) + SECP_256K1_B) % SECP_256K1_P
+        # solve for left side; the constructor rejects x when alpha has no root
+        beta = s256_sqrt(alpha)
+        if (beta % 2 == 0) == is_even:
+            return S256Point(x, beta)
         else:
-            even_beta = S256Field(SECP_256K1_P - beta.num)
-            odd_beta = beta
-        if is_even:
-            return S256Point(x, even_beta)
-        else:
-            return S256Point(x, odd_beta)
+            return S256Point(x, (SECP_256K1_P - beta) % SECP_256K1_P)
 
     def address(self, compressed=True, testnet=False):
         '''
@@ -97,6 +638,87 @@ class S256Test(TestCase):
         point = SECP_256K1_N * SECP_256K1_G
         self.assertIsNone(point.x)
 
+    def test_rmul_matches_affine(self):
+        for coefficient in (1, 2, 3, 0xdeadbeef, 2**255 + 19, SECP_256K1_N - 1):
+            want = Point.__rmul__(SECP_256K1_G, coefficient)
+            self.assertEqual(coefficient * SECP_256K1_G, want)
+        point = 12345 * SECP_256K1_G
+        self.assertEqual(67890 * point, Point.__rmul__(point, 67890))
+        self.assertIsNone((0 * point).x)
+
+    def test_generator_table(self):
+        table = generator_table()
+        for coefficient in (1, 255, 256, 0xdeadbeef, 2**255 + 19, SECP_256K1_N - 1):
+            want = S256Point.from_jacobian(jacobian_mul(coefficient, SECP_256K1_G.x.num, SECP_256K1_G.y.num))
+            self.assertEqual(S256Point.from_jacobian(table.multiply(coefficient)), want)
+        # scalars outside [0, N) are reduced before the lookup
+        for coefficient in (SECP_256K1_N, 2**256 + 5, 2**300, -3):
+            want = S256Point.from_jacobian(jacobian_mul(coefficient % SECP_256K1_N, SECP_256K1_G.x.num, SECP_256K1_G.y.num))
+            self.assertEqual(S256Point.from_jacobian(table.multiply(coefficient)), want)
+            self.assertEqual(S256Point.from_jacobian(generator_mul(coefficient)), want)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'g.table')
+            table.save(filename)
+            mapped = GeneratorTable.load(filename)
+            self.assertEqual(mapped.multiply(0xdeadbeef), table.multiply(0xdeadbeef))
+            mapped.data.close()
+
+    def test_wnaf(self):
+        for coefficient in (1, 7, 0xdeadbeef, SECP_256K1_N - 1):
+            digits = wnaf(coefficient, WNAF_WIDTH)
+            self.assertEqual(sum(d << i for i, d in enumerate(digits)), coefficient)
+            for i, digit in enumerate(digits):
+                if digit:
+                    self.assertEqual(digit % 2, 1)
+                    self.assertTrue(abs(digit) < 1 << (WNAF_WIDTH - 1))
+                    self.assertFalse(any(digits[i + 1:i + WNAF_WIDTH]))
+
+    def test_multi_mul(self):
+        p = 1234567 * SECP_256K1_G
+        q = 7654321 * SECP_256K1_G
+        pairs = [(0xdeadbeef, p), (2**200 + 5, q), (SECP_256K1_N - 3, SECP_256K1_G)]
+        want = Point.__rmul__(p, 0xdeadbeef) + Point.__rmul__(q, 2**200 + 5) \
+            + Point.__rmul__(SECP_256K1_G, SECP_256K1_N - 3)
+        self.assertEqual(S256Point.multi_mul(pairs), want)
+        self.assertIsNone(S256Point.multi_mul([(5, p), (SECP_256K1_N - 5, p)]).x)
+        self.assertIsNone(S256Point.multi_mul([]).x)
+
+    def test_glv_split(self):
+        for coefficient in (1, 0xdeadbeef, 2**255 + 19, SECP_256K1_N - 1):
+            k1, k2 = glv_split(coefficient)
+            self.assertEqual((k1 + k2 * SECP_256K1_LAMBDA) % SECP_256K1_N, coefficient)
+            self.assertLess(abs(k1).bit_length(), 130)
+            self.assertLess(abs(k2).bit_length(), 130)
+        point = SECP_256K1_LAMBDA * SECP_256K1_G
+        self.assertEqual(point.x.num, SECP_256K1_BETA * SECP_256K1_G.x.num % SECP_256K1_P)
+        self.assertEqual(point.y, SECP_256K1_G.y)
+
+    def test_glv_rmul(self):
+        point = 0xc0ffee * SECP_256K1_G
+        for coefficient in (1, 2, 0xdeadbeef, 2**255 + 19, SECP_256K1_N - 1, SECP_256K1_LAMBDA):
+            want = Point.__rmul__(point, coefficient)
+            glv = S256Point.from_jacobian(jacobian_multi_mul([(coefficient, point)], glv=True))
+            plain = S256Point.from_jacobian(jacobian_multi_mul([(coefficient, point)], glv=False))
+            self.assertEqual(glv, want)
+            self.assertEqual(plain, want)
+
+    def test_normalize_batch(self):
+        points = [jacobian_double((k * SECP_256K1_G).to_jacobian()) for k in (1, 2, 3, 0xdeadbeef)]
+        points.insert(2, JACOBIAN_INFINITY)
+        normalized = S256Point.normalize_batch(points)
+        self.assertEqual(normalized, [S256Point.from_jacobian(p) for p in points])
+        self.assertIsNone(normalized[2].x)
+        self.assertEqual(normalized[-1], (2 * 0xdeadbeef) * SECP_256K1_G)
+        self.assertEqual(S256Point.normalize_batch([]), [])
+
+    def test_jacobian_add(self):
+        p = (5 * SECP_256K1_G).to_jacobian()
+        q = (7 * SECP_256K1_G).to_jacobian()
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(p, q)), 12 * SECP_256K1_G)
+        self.assertEqual(S256Point.from_jacobian(jacobian_add(p, p)), 10 * SECP_256K1_G)
+        minus_p = (SECP_256K1_N - 5) * SECP_256K1_G
+        self.assertIsNone(S256Point.from_jacobian(jacobian_add(p, minus_p.to_jacobian())).x)
+
     def test_pubpoint(self):
         # write a test that tests the public point for the following
         points = (
@@ -127,6 +749,45 @@ class S256Test(TestCase):
         s = 0xc7207fee197d27c618aea621406f6bf5ef6fca38681d82b2f06fddbdce6feab6
         self.assertTrue(point.verify(z, Signature(r, s)))
 
+    def test_verify_batch(self):
+        point = S256Point(
+            0x887387e452b8eacc4acfde10d9aaf7f6d9a0f975aabb10d006e4da568744d06c,
+            0x61de6d95231cd89026e286df3b6ae4a894a3378e393e93a0f45b666329a0ae34)
+        z = 0xec208baa0fc1c19f708a9ca96fdeff3ac3f230bb4a7ba4aede4942ad003c0f60
+        sig = Signature(0xac8d1c87e51d0d441be8b3dd5b05c8795b48875dffe00b7ffcfac23010d3a395,
+                        0x68342ceff8935ededd102dd876ffd6ba72d6a427a3edb13d26eb0781cb423c4)
+        items = [(point, z, sig)] * 5 + [(point, z + 1, sig)] + [(point, z, sig)] * 2
+        want = [True] * 5 + [False] + [True] * 2
+        self.assertEqual(S256Point.verify_batch(items, max_workers=1), want)
+        self.assertEqual(S256Point.verify_batch(items, max_workers=2, chunk_size=3), want)
+        self.assertFalse(S256Point.verify_batch(items, max_workers=2, chunk_size=3, fail_fast=True))
+        self.assertFalse(S256Point.verify_batch(items, max_workers=1, fail_fast=True))
+        self.assertTrue(S256Point.verify_batch(items[:5], max_workers=2, chunk_size=2, fail_fast=True))
+        self.assertEqual(S256Point.verify_batch([]), [])
+        SIGNATURE_CACHE.clear()
+        self.assertEqual(S256Point.verify_batch(items, max_workers=1), want)
+        self.assertEqual(S256Point.verify_batch(items, max_workers=1), want)
+        self.assertEqual(SIGNATURE_CACHE.stats()['hits'], 7)
+        # a pubkey at infinity fails its own item only
+        infinity = S256Point(None, None)
+        self.assertEqual(S256Point.verify_batch([(infinity, z, sig)] + items, max_workers=1), [False] + want)
+        self.assertFalse(S256Point.verify_batch([(infinity, z, sig)], fail_fast=True))
+        # the pool is kept between calls, or given by the caller
+        SIGNATURE_CACHE.clear()
+        S256Point.verify_batch(items, max_workers=2, chunk_size=3)
+        executor = S256Point.executors[2]
+        SIGNATURE_CACHE.clear()
+        self.assertEqual(S256Point.verify_batch(items, max_workers=2, chunk_size=3), want)
+        self.assertIs(S256Point.executors[2], executor)
+        # another size gets its own pool and leaves this one running
+        SIGNATURE_CACHE.clear()
+        self.assertEqual(S256Point.verify_batch(items, max_workers=3, chunk_size=3), want)
+        self.assertIs(S256Point.shared_executor(2), executor)
+        self.assertEqual(executor.submit(verify_chunk, []).result(), [])
+        SIGNATURE_CACHE.clear()
+        with ProcessPoolExecutor(2) as own:
+            self.assertEqual(S256Point.verify_batch(items, chunk_size=3, executor=own), want)
+
     def test_sec(self):
         coefficient = 999**3
         uncompressed = '049d5ca49670cbe4c3bfa84c96a8c87df086c6ea6a24ba6b809c9de234496808d56fa15cc7f3d38cda98dee2419f415b7513dde1301f8643cd9245aea7f3f911f9'
@@ -147,6 +808,31 @@ class S256Test(TestCase):
         self.assertEqual(point.sec(compressed=False), bytes.fromhex(uncompressed))
         self.assertEqual(point.sec(compressed=True), bytes.fromhex(compressed))
 
+    def test_parse(self):
+        for coefficient in (1, 999**3, 123, 42424242):
+            point = coefficient * SECP_256K1_G
+            self.assertEqual(S256Point.parse(point.sec(compressed=True)), point)
+            self.assertEqual(S256Point.parse(point.sec(compressed=False)), point)
+        with self.assertRaises(ValueError):
+            S256Point.parse(b'\x02' + (5).to_bytes(32, 'big'))
+
+    def test_parse_cache(self):
+        sec = (0xfeedbeef * SECP_256K1_G).sec()
+        S256Point.parse_cache.clear()
+        first = S256Point.parse(sec)
+        self.assertIs(S256Point.parse(sec), first)
+        stats = S256Point.parse_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        with self.assertRaises(ValueError):
+            S256Point.parse(b'\x02' + (5).to_bytes(32, 'big'))
+        self.assertEqual(len(S256Point.parse_cache), 1)
+        # the shared point cannot be changed under other callers
+        with self.assertRaises(AttributeError):
+            first.x = SECP_256K1_G.x
+        with self.assertRaises(AttributeError):
+            del first.y
+        self.assertEqual(S256Point.parse(sec), 0xfeedbeef * SECP_256K1_G)
+
     def test_address(self):
         secret = 888 ** 3
         mainnet_address = '148dY81A9BmdpMhvYEVznrM45kWN32vSCN'
@@ -2,8 +2,36 @@ import logging
 from io import BytesIO
 from unittest import TestCase
 
-from AddressCoder import encode_varint, read_varint
-from Operation import OP_CODE_NAMES, OP_CODE_FUNCTIONS, op_hash160, op_equal, op_verify
+from AddressCoder import check_space, encode_varint, hash160, read_varint, varint_size, write_bytes, write_varint
+from LRUCache import LRUCache
+import ScriptProfiler
+from Operation import MAX_PUBKEYS_PER_MULTISIG, OP_CODE_NAMES, OP_CODE_FUNCTIONS, decode_num, encode_num, op_hash160, op_equal, op_verify
+
+# number of compiled programs kept, keyed by their serialized script
+COMPILED_CACHE_SIZE = 4096
+
+# consensus limits enforced while evaluating
+MAX_SCRIPT_ELEMENT_SIZE = 520   # bytes in one pushed element
+MAX_OPS_PER_SCRIPT = 201        # non-push opcodes, plus the keys of each multisig
+MAX_STACK_SIZE = 1000           # elements on the stack and altstack together
+
+# calling conventions of compiled instructions
+PUSH = 0        # push the argument
+OP = 1          # handler(stack)
+OP_ALTSTACK = 2 # handler(stack, altstack)
+OP_SIG = 3      # handler(stack, z)
+IF = 4          # pop; jump to the target unless true
+NOTIF = 5       # pop; jump to the target unless false
+JUMP = 6        # jump to the target
+NOP = 7         # OP_ENDIF and extra OP_ELSEs
+P2SH = 8        # OP_HASH160 <h160> OP_EQUAL ending the script, after a push
+INVALID = 9     # fail when executed
+MARK = 10       # handler(cmd, depth) before each instruction, when profiling
+
+# opcodes that only push a number
+PUSH_NUMBERS = {0: encode_num(0), 79: encode_num(-1)}
+for n in range(1, 17):
+    PUSH_NUMBERS[80 + n] = encode_num(n)
 
 
 def p2pkh_script(h160):
@@ -15,12 +43,316 @@ def p2sh_script(h160):
     '''Takes a hash160 and returns the p2sh ScriptPubKey'''
     return Script([0xa9, h160, 0x87])
 
-class Script(object):
-    def __init__(self, cmds=None):
-        if cmds is None:
-            self.cmds = []
+
+def push_header(length):
+    '''
+    returns the opcode and length bytes that push length bytes of data
+    '''
+    if length <= 75:
+        return bytes([length])
+    elif length < 0x100:
+        # op_pushdata1
+        return b'\x4c' + length.to_bytes(1, 'little')
+    elif length < 0x10000:
+        # op_pushdata2
+        return b'\x4d' + length.to_bytes(2, 'little')
+    elif length < 0x100000000:
+        # op_pushdata4
+        return b'\x4e' + length.to_bytes(4, 'little')
+    else:
+        raise ValueError('too long an cmd')
+
+
+def push_header_size(length):
+    if length <= 75:
+        return 1
+    elif length < 0x100:
+        return 2
+    elif length < 0x10000:
+        return 3
+    return 5
+
+
+def tokenize(raw):
+    '''
+    splits serialized script bytes (without the length prefix) into
+    cmds: bytes for pushed data, ints for opcodes
+    '''
+    cmds = []
+    length = len(raw)
+    i = 0
+    while i < length:
+        current_byte = raw[i]
+        i += 1
+        if 1 <= current_byte <= 75:
+            data_length = current_byte
+        elif current_byte == 76:
+            # op_pushdata1
+            data_length = int.from_bytes(raw[i:i + 1], 'little')
+            i += 1
+        elif current_byte == 77:
+            # op_pushdata2
+            data_length = int.from_bytes(raw[i:i + 2], 'little')
+            i += 2
+        elif current_byte == 78:
+            # op_pushdata4
+            data_length = int.from_bytes(raw[i:i + 4], 'little')
+            i += 4
         else:
-            self.cmds = cmds
+            # we have an opcode
+            cmds.append(current_byte)
+            continue
+        if i + data_length > length:
+            raise SyntaxError('parsing script failed')
+        cmds.append(bytes(raw[i:i + data_length]))
+        i += data_length
+    if i != length:
+        raise SyntaxError('parsing script failed')
+    return cmds
+
+
+def branch_targets(cmds):
+    '''
+    Resolves the conditionals of a command list to jump targets: an OP_IF or
+    OP_NOTIF maps to the command after its first OP_ELSE (or its OP_ENDIF),
+    and that OP_ELSE maps to the command after the OP_ENDIF. Any further
+    OP_ELSE of the same OP_IF is skipped over. Returns None when the
+    conditionals are unbalanced.
+    '''
+    targets = {}
+    open_ifs = []
+    for i, cmd in enumerate(cmds):
+        if type(cmd) != int:
+            continue
+        if cmd in (99, 100):
+            open_ifs.append([i, None])
+        elif cmd == 103:
+            if not open_ifs:
+                return None
+            if open_ifs[-1][1] is None:
+                open_ifs[-1][1] = i
+                targets[open_ifs[-1][0]] = i + 1
+        elif cmd == 104:
+            if not open_ifs:
+                return None
+            if_index, else_index = open_ifs.pop()
+            if else_index is None:
+                targets[if_index] = i + 1
+            else:
+                targets[else_index] = i + 1
+    if open_ifs:
+        return None
+    return targets
+
+
+class CompiledScript:
+    '''
+    A command list turned into a flat program of (kind, argument, target,
+    opcode) instructions: handlers are looked up and conditionals resolved
+    to jump targets once, when the script is compiled.
+    '''
+    cache = LRUCache(COMPILED_CACHE_SIZE)
+
+    def __init__(self, instructions, op_count=0, error=None, profiler=None):
+        self.instructions = tuple(instructions)
+        # non-push opcodes in the script, counted whether they run or not
+        self.op_count = op_count
+        # why the script fails no matter what it is run on, if it does
+        self.error = error
+        self.profiler = profiler
+
+    @property
+    def valid(self):
+        return self.error is None
+
+    @classmethod
+    def compile(cls, cmds):
+        branches = branch_targets(cmds)
+        if branches is None:
+            return cls([], error='unbalanced conditional')
+        op_count = 0
+        for cmd in cmds:
+            if type(cmd) == int:
+                if cmd > 0x60:
+                    op_count += 1
+            elif len(cmd) > MAX_SCRIPT_ELEMENT_SIZE:
+                return cls([], error='push larger than {} bytes'.format(MAX_SCRIPT_ELEMENT_SIZE))
+        if op_count > MAX_OPS_PER_SCRIPT:
+            return cls([], error='more than {} ops'.format(MAX_OPS_PER_SCRIPT))
+        instructions = []
+        p2sh_start = len(cmds) - 3
+        if not (p2sh_start >= 0 and cmds[p2sh_start] == 0xa9
+                and type(cmds[p2sh_start + 1]) == bytes and len(cmds[p2sh_start + 1]) == 20
+                and cmds[p2sh_start + 2] == 0x87
+                and (p2sh_start == 0 or type(cmds[p2sh_start - 1]) == bytes)):
+            p2sh_start = None
+        for i, cmd in enumerate(cmds):
+            if i == p2sh_start:
+                instructions.append((P2SH, cmds[i + 1], None, cmd))
+                break
+            if type(cmd) != int:
+                instructions.append((PUSH, cmd, None, None))
+            elif cmd == 99:
+                instructions.append((IF, None, branches[i], cmd))
+            elif cmd == 100:
+                instructions.append((NOTIF, None, branches[i], cmd))
+            elif cmd == 103 and i in branches:
+                instructions.append((JUMP, None, branches[i], cmd))
+            elif cmd in (103, 104):
+                instructions.append((NOP, None, None, cmd))
+            elif cmd not in OP_CODE_FUNCTIONS or cmd in (177, 178):
+                # unknown opcodes, and the locktime checks, which need
+                # transaction context the interpreter does not have
+                instructions.append((INVALID, None, None, cmd))
+            elif cmd in (107, 108):  # OP_TOALTSTACK and OP_FROMALTSTACK
+                instructions.append((OP_ALTSTACK, OP_CODE_FUNCTIONS[cmd], None, cmd))
+            elif cmd in (172, 173, 174, 175):  # signature verify
+                instructions.append((OP_SIG, OP_CODE_FUNCTIONS[cmd], None, cmd))
+            else:
+                instructions.append((OP, OP_CODE_FUNCTIONS[cmd], None, cmd))
+        return cls(instructions, op_count)
+
+    @classmethod
+    def compile_raw(cls, raw):
+        '''
+        returns the compiled program for serialized script bytes (without
+        the length prefix), from the cache when possible
+        '''
+        program = cls.cache.get(raw)
+        if program is None:
+            program = cls.compile(tokenize(raw))
+            cls.cache.put(raw, program)
+        return program
+
+    def profiled(self, profiler):
+        '''
+        returns a copy of the program that reports every instruction to
+        profiler, so programs run without one carry no profiling cost
+        '''
+        instructions = []
+        for kind, argument, target, cmd in self.instructions:
+            if target is not None:
+                target *= 2
+            instructions.append((MARK, profiler.step, None, cmd))
+            instructions.append((kind, argument, target, cmd))
+        return CompiledScript(instructions, self.op_count, self.error, profiler)
+
+    def run(self, stack, altstack, z, after_push=False, p2sh=True):
+        '''
+        Executes the program on the given stacks. after_push tells whether
+        the command right before it pushed data, which decides if a program
+        that is just OP_HASH160 <h160> OP_EQUAL runs as p2sh. With p2sh
+        False the pattern is never more than a hash comparison, as for
+        RedeemScripts and witness scripts.
+        '''
+        if self.error is not None:
+            logging.info(self.error)
+            return False
+        instructions = self.instructions
+        op_count = self.op_count
+        ip = 0
+        end = len(instructions)
+        while ip < end:
+            kind, argument, target, cmd = instructions[ip]
+            ip += 1
+            if kind == PUSH:
+                stack.append(argument)
+                if len(stack) + len(altstack) > MAX_STACK_SIZE:
+                    logging.info('stack too large')
+                    return False
+            elif kind == OP:
+                if not argument(stack):
+                    logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                    return False
+                if len(stack) + len(altstack) > MAX_STACK_SIZE:
+                    logging.info('stack too large')
+                    return False
+            elif kind == OP_SIG:
+                if cmd >= 174 and stack:
+                    # OP_CHECKMULTISIG(VERIFY) also counts its keys as ops
+                    n = decode_num(stack[-1])
+                    if n < 0:
+                        logging.info('negative key count')
+                        return False
+                    op_count += n
+                    if op_count > MAX_OPS_PER_SCRIPT:
+                        logging.info('more than {} ops'.format(MAX_OPS_PER_SCRIPT))
+                        return False
+                if not argument(stack, z):
+                    logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                    return False
+            elif kind == IF or kind == NOTIF:
+                if len(stack) < 1:
+                    logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                    return False
+                condition = decode_num(stack.pop()) != 0
+                if condition == (kind == NOTIF):
+                    ip = target
+            elif kind == JUMP:
+                ip = target
+            elif kind == NOP:
+                continue
+            elif kind == OP_ALTSTACK:
+                if not argument(stack, altstack):
+                    logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+                    return False
+            elif kind == P2SH:
+                if len(stack) < 1:
+                    return False
+                redeem_script = stack[-1]
+                if not op_hash160(stack):
+                    return False
+                stack.append(argument)
+                if not op_equal(stack):
+                    return False
+                if p2sh and (ip > 1 or after_push):
+                    # final result should be a 1
+                    if not op_verify(stack):
+                        logging.info('bad p2sh h160')
+                        return False
+                    # hashes match! the RedeemScript is all that is left to run
+                    try:
+                        program = self.compile_raw(redeem_script)
+                    except SyntaxError:
+                        logging.info('bad RedeemScript')
+                        return False
+                    if self.profiler is not None:
+                        program = program.profiled(self.profiler)
+                    return program.run(stack, altstack, z, p2sh=False)
+                return True
+            elif kind == MARK:
+                argument(cmd, len(stack) + len(altstack))
+            else:
+                logging.info('bad op: {}'.format(OP_CODE_NAMES.get(cmd, cmd)))
+                return False
+        return True
+
+
+class Script(object):
+    '''
+    A script is kept as the raw bytes it was parsed from and only split
+    into cmds when something looks at them, so transactions that are just
+    hashed, relayed or stored never tokenize their scripts. Assigning cmds
+    drops the raw bytes; the cmds list itself should not be changed in
+    place.
+    '''
+
+    def __init__(self, cmds=None, raw=None):
+        if cmds is None and raw is None:
+            cmds = []
+        self._cmds = cmds
+        self.raw = raw
+
+    @property
+    def cmds(self):
+        if self._cmds is None:
+            self._cmds = tokenize(self.raw)
+        return self._cmds
+
+    @cmds.setter
+    def cmds(self, cmds):
+        self._cmds = cmds
+        self.raw = None
 
     def __repr__(self):
         result = []
@@ -36,115 +368,148 @@ class Script(object):
         return ' '.join(result)
 
     def __add__(self, other):
-        return Script(self.cmds + other.cmds)
+        return Script(list(self.cmds) + list(other.cmds))
 
     @classmethod
     def parse(cls, s):
         length = read_varint(s)
-        cmds = []
-        count = 0
-        while count < length:
-            current = s.read(1)
-            count += 1
-            current_byte = current[0]
-            if 1 <= current_byte <= 75:
-                cmds.append(s.read(current_byte))
-                count += current_byte
-            elif current_byte == 76:
-                # op_pushdata1
-                data_length = int.from_bytes(s.read(1), 'little')
-                cmds.append(s.read(data_length))
-                count += data_length + 1
-            elif current_byte == 77:
-                # op_pushdata2
-                data_length = int.from_bytes(s.read(2), 'little')
-                cmds.append(s.read(data_length))
-                count += data_length + 2
-            else:
-                # we have an opcode. set the current byte to op_code
-                # add the op_code to the list of cmds
-                cmds.append(current_byte)
-        if count != length:
+        raw = s.read(length)
+        if len(raw) != length:
             raise SyntaxError('parsing script failed')
-        return cls(cmds)
+        return cls(raw=raw)
+
+    def raw_size(self):
+        '''
+        returns the length of the serialized script, without its varint
+        '''
+        if self.raw is not None:
+            return len(self.raw)
+        total = 0
+        for cmd in self.cmds:
+            if type(cmd) == int:
+                total += 1
+            else:
+                total += push_header_size(len(cmd)) + len(cmd)
+        return total
+
+    def size(self):
+        raw_size = self.raw_size()
+        return varint_size(raw_size) + raw_size
 
     def serialize(self):
-        result = self.raw_serialize()
-        total = len(result)
-        return encode_varint(total) + result
+        buf = bytearray(self.size())
+        self.serialize_into(buf, 0)
+        return bytes(buf)
+
+    def serialize_into(self, buf, offset):
+        '''
+        writes the length-prefixed script into buf at offset, returns the
+        offset just past it
+        '''
+        raw_size = self.raw_size()
+        check_space(buf, offset, varint_size(raw_size) + raw_size)
+        offset = write_varint(buf, offset, raw_size)
+        return self.raw_serialize_into(buf, offset)
 
     def raw_serialize(self):
-        result = b''
+        if self.raw is not None:
+            return self.raw
+        buf = bytearray(self.raw_size())
+        self.raw_serialize_into(buf, 0)
+        return bytes(buf)
+
+    def raw_serialize_into(self, buf, offset):
+        if self.raw is not None:
+            return write_bytes(buf, offset, self.raw)
+        check_space(buf, offset, self.raw_size())
         for cmd in self.cmds:
             if type(cmd) == int:
-                result += cmd.to_bytes(1, 'little')
+                buf[offset] = cmd
+                offset += 1
             else:
-                length = len(cmd)
-                if length < 75:
-                    result += length.to_bytes(1, 'little')
-                elif 75 < length < 0x100:
-                    result += 0x76
-                    result += length.to_bytes(1, 'little')
-                elif 0x100 <= length <= 520:
-                    result += 0x77
-                    result += length.to_bytes(2, 'little')
-                else:
-                    raise ValueError('too long an cmd')
-                result += cmd
-        return result
+                offset = write_bytes(buf, offset, push_header(len(cmd)))
+                offset = write_bytes(buf, offset, cmd)
+        return offset
+
+    def compile(self):
+        '''
+        returns the CompiledScript for this script, from the cache when the
+        same script bytes were compiled before
+        '''
+        return CompiledScript.compile_raw(self.raw_serialize())
 
-    def evaluate(self, z):
-        cmds = self.cmds[:]
+    def evaluate(self, z, p2sh=True):
+        '''
+        runs the script against the signature hash z, or a function that
+        returns it for a sighash type; p2sh False turns off the p2sh rule,
+        for witness scripts
+        '''
+        try:
+            cmds = self.cmds
+        except SyntaxError:
+            return False
+        profiler = ScriptProfiler.ACTIVE
         stack = []
         altstack = []
-        while len(cmds) > 0:
-            cmd = cmds.pop(0)
-            if type(cmd) == int:
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):  # OP_IF and OP_NOTIF
-                    if not operation(stack, cmds):
-                        logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (107, 108):  # OP_TOTALSTACK and OP_FROMALTSTACK
-                    if not operation(stack, altstack):
-                        logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (172, 173, 174, 175):  # signature verify
-                    if not operation(stack, z):
-                        logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
+        # leading pushes, which is all of a standard ScriptSig, go straight
+        # onto the stack, so the part that gets compiled and cached is the
+        # ScriptPubKey the same templates keep repeating
+        start = 0
+        if profiler is None:
+            for cmd in cmds:
+                if type(cmd) == bytes:
+                    if len(cmd) > MAX_SCRIPT_ELEMENT_SIZE:
                         return False
+                    stack.append(cmd)
+                elif cmd in PUSH_NUMBERS:
+                    stack.append(PUSH_NUMBERS[cmd])
                 else:
-                    if not operation(stack):
-                        logging.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-            else:
-                stack.append(cmd)
-                if len(cmds) == 3 and cmds[0] == 0xa9 \
-                    and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
-                    and cmds[2] == 0x87:  # p2sh
-                    # we execute the next three opcodes
-                    cmds.pop()
-                    h160 = cmds.pop()
-                    cmds.pop()
-                    if not op_hash160(stack):
-                        return False
-                    stack.append(h160)
-                    if not op_equal(stack):
-                        return False
-                    # final result should be a 1
-                    if not op_verify(stack):
-                        logging.info('bad p2sh h160')
-                        return False
-                    # hashes match! now add the RedeemScript
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    stream = BytesIO(redeem_script)
-                    cmds.extend(Script.parse(stream).cmds)
+                    break
+                start += 1
+            if start > MAX_STACK_SIZE:
+                return False
+        program = Script(cmds[start:]).compile()
+        after_push = start > 0 and type(cmds[start - 1]) == bytes
+        if profiler is None:
+            if not program.run(stack, altstack, z, after_push, p2sh):
+                return False
+        else:
+            try:
+                if not program.profiled(profiler).run(stack, altstack, z, after_push, p2sh):
+                    return False
+            finally:
+                profiler.finish(len(stack) + len(altstack))
         if len(stack) == 0:
             return False
         if stack.pop() == b'':
             return False
         return True
 
+    def sigop_count(self, accurate=False):
+        '''
+        Counts signature checks without running anything. An
+        OP_CHECKMULTISIG counts as MAX_PUBKEYS_PER_MULTISIG unless accurate
+        is set and its key count is pushed by OP_1..OP_16 right before it,
+        as in a RedeemScript. A script that does not tokenize counts as 0,
+        it fails before any check.
+        '''
+        try:
+            cmds = self.cmds
+        except SyntaxError:
+            return 0
+        count = 0
+        last = None
+        for cmd in cmds:
+            if cmd == 0xac or cmd == 0xad:
+                count += 1
+            elif cmd == 0xae or cmd == 0xaf:
+                if accurate and type(last) == int and 0x51 <= last <= 0x60:
+                    count += last - 0x50
+                else:
+                    count += MAX_PUBKEYS_PER_MULTISIG
+            last = cmd
+        return count
+
     def is_p2pkh_script_pubkey(self):
         '''Returns whether this follows the
         OP_DUP OP_HASH160 <20 byte hash> OP_EQUALVERIFY OP_CHECKSIG pattern.'''
@@ -160,6 +525,30 @@ class Script(object):
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20 \
             and self.cmds[2] == 0x87
 
+    def is_p2wpkh_script_pubkey(self):
+        '''Returns whether this follows the
+        OP_0 <20 byte hash> pattern.'''
+        return len(self.cmds) == 2 and self.cmds[0] == 0x00 \
+            and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20
+
+    def is_p2wsh_script_pubkey(self):
+        '''Returns whether this follows the
+        OP_0 <32 byte hash> pattern.'''
+        return len(self.cmds) == 2 and self.cmds[0] == 0x00 \
+            and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 32
+
+    def is_multisig_script(self):
+        '''Returns whether this follows the
+        OP_m <pubkey> ... <pubkey> OP_n OP_CHECKMULTISIG pattern.'''
+        cmds = self.cmds
+        if len(cmds) < 4 or cmds[-1] != 0xae:
+            return False
+        m, n = cmds[0], cmds[-2]
+        if type(m) != int or type(n) != int or not 0x51 <= m <= n <= 0x60:
+            return False
+        return len(cmds) == n - 0x50 + 3 \
+            and all(type(cmd) == bytes for cmd in cmds[1:-2])
+
 
 class ScriptTest(TestCase):
     def test_parse(self):
@@ -174,4 +563,137 @@ class ScriptTest(TestCase):
         want = '6a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937'
         script_pubkey = BytesIO(bytes.fromhex(want))
         script = Script.parse(script_pubkey)
-        self.assertEqual(script.serialize().hex(), want)
\ No newline at end of file
+        self.assertEqual(script.serialize().hex(), want)
+
+    def test_pushdata(self):
+        for length, header in ((75, '4b'), (76, '4c4c'), (255, '4cff'), (256, '4d0001'), (0x10000, '4e00000100')):
+            cmds = [0x76, b'\x01' * length, 0x87]
+            script = Script(cmds)
+            raw = script.raw_serialize()
+            self.assertEqual(raw[1:1 + len(header) // 2].hex(), header)
+            self.assertEqual(len(raw), script.raw_size())
+            self.assertEqual(tokenize(raw), cmds)
+            buf = bytearray(script.size() + 2)
+            self.assertEqual(script.serialize_into(buf, 1), len(buf) - 1)
+            self.assertEqual(bytes(buf[1:-1]), script.serialize())
+            # a short buffer is an error, not something to grow
+            for size in (script.size() - 1, 2):
+                short = bytearray(size)
+                with self.assertRaises(ValueError):
+                    script.serialize_into(short, 0)
+                self.assertEqual(len(short), size)
+        with self.assertRaises(ValueError):
+            Script(raw=bytes(3)).raw_serialize_into(bytearray(2), 0)
+        with self.assertRaises(ValueError):
+            Script([0x76, 0x87]).raw_serialize_into(bytearray(2), 1)
+
+    def test_lazy(self):
+        raw = bytes.fromhex('76a914338c84849423992471bffb1a54a8d9b1d69dc28a88ac')
+        script = Script.parse(BytesIO(encode_varint(len(raw)) + raw))
+        self.assertIsNone(script._cmds)
+        self.assertEqual(script.raw_serialize(), raw)
+        self.assertTrue(script.is_p2pkh_script_pubkey())
+        self.assertIs(script.raw_serialize(), script.raw)
+        script.cmds = script.cmds[:2]
+        self.assertEqual(script.raw_serialize(), raw[:2])
+        # a push running past the end only fails once it is tokenized
+        script = Script.parse(BytesIO(bytes.fromhex('024c05')))
+        with self.assertRaises(SyntaxError):
+            script.cmds
+        self.assertFalse(script.evaluate(0))
+
+    def test_evaluate_if(self):
+        # OP_1 OP_IF OP_2 OP_ELSE OP_3 OP_ENDIF OP_2 OP_EQUAL
+        self.assertTrue(Script([0x51, 0x63, 0x52, 0x67, 0x53, 0x68, 0x52, 0x87]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x63, 0x53, 0x67, 0x52, 0x68, 0x52, 0x87]).evaluate(0))
+        # OP_0 OP_IF OP_2 OP_ELSE OP_3 OP_ENDIF OP_3 OP_EQUAL
+        self.assertTrue(Script([0x00, 0x63, 0x52, 0x67, 0x53, 0x68, 0x53, 0x87]).evaluate(0))
+        # OP_0 OP_NOTIF OP_1 OP_IF OP_4 OP_ENDIF OP_ELSE OP_RETURN OP_ENDIF OP_4 OP_EQUAL
+        cmds = [0x00, 0x64, 0x51, 0x63, 0x54, 0x68, 0x67, 0x6a, 0x68, 0x54, 0x87]
+        self.assertTrue(Script(cmds).evaluate(0))
+        # OP_0 OP_IF OP_RETURN OP_ENDIF OP_1, with no else branch
+        self.assertTrue(Script([0x00, 0x63, 0x6a, 0x68, 0x51]).evaluate(0))
+
+    def test_evaluate_unbalanced(self):
+        self.assertFalse(Script([0x51, 0x63, 0x51]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x68]).evaluate(0))
+        self.assertFalse(Script([0x51, 0x67, 0x51]).evaluate(0))
+        self.assertFalse(Script([0x63, 0x68]).evaluate(0))
+
+    def test_is_multisig_script(self):
+        sec = bytes(33)
+        self.assertTrue(Script([0x51, sec, 0x51, 0xae]).is_multisig_script())
+        self.assertTrue(Script([0x52, sec, sec, sec, 0x53, 0xae]).is_multisig_script())
+        self.assertFalse(Script([0x53, sec, sec, 0x52, 0xae]).is_multisig_script())
+        self.assertFalse(Script([0x52, sec, sec, 0x53, 0xae]).is_multisig_script())
+        self.assertFalse(Script([0x51, 0x51, 0x51, 0xae]).is_multisig_script())
+        self.assertFalse(p2pkh_script(bytes(20)).is_multisig_script())
+
+    def test_compile(self):
+        script_pubkey = p2pkh_script(bytes(20))
+        program = script_pubkey.compile()
+        self.assertIs(script_pubkey.compile(), program)
+        self.assertEqual([i[0] for i in program.instructions], [OP, OP, PUSH, OP, OP_SIG])
+        program = Script([0x63, 0x51, 0x67, 0x52, 0x67, 0x53, 0x68]).compile()
+        self.assertEqual([(i[0], i[2]) for i in program.instructions],
+                         [(IF, 3), (OP, None), (JUMP, 7), (OP, None), (NOP, None), (OP, None), (NOP, None)])
+        self.assertFalse(Script([0x63]).compile().valid)
+        self.assertEqual(Script([0xb1]).compile().instructions[0][0], INVALID)
+        self.assertEqual(Script([0x76, 0x87, b'\x01']).compile().op_count, 2)
+
+    def test_limits(self):
+        # OP_1 OP_DROP repeated stays within the op limit
+        self.assertTrue(Script([0x51] + [0x51, 0x75] * MAX_OPS_PER_SCRIPT).evaluate(0))
+        self.assertFalse(Script([0x51] + [0x51, 0x75] * (MAX_OPS_PER_SCRIPT + 1)).evaluate(0))
+        # ops in a branch that does not run still count
+        cmds = [0x00, 0x63] + [0x61] * MAX_OPS_PER_SCRIPT + [0x68, 0x51]
+        self.assertFalse(Script(cmds).evaluate(0))
+        self.assertFalse(Script([b'\x01' * 521, 0x75, 0x51]).evaluate(0))
+        self.assertFalse(Script([0x51, b'\x01' * 521, 0x75]).evaluate(0))
+        self.assertTrue(Script([0x51, b'\x01' * 520, 0x75]).evaluate(0))
+        # OP_NOP, pushes, then OP_3DUP
+        self.assertTrue(Script([0x61] + [b'\x01'] * (MAX_STACK_SIZE - 3) + [0x6f]).evaluate(0))
+        self.assertFalse(Script([0x61] + [b'\x01'] * (MAX_STACK_SIZE - 2) + [0x6f]).evaluate(0))
+        self.assertFalse(Script([0x61] + [b'\x01'] * (MAX_STACK_SIZE + 1)).evaluate(0))
+        self.assertFalse(Script([b'\x01'] * (MAX_STACK_SIZE + 1)).evaluate(0))
+        # the keys of an OP_CHECKMULTISIG are ops too: a 0-of-3 multisig
+        # is 4 ops, which with 197 OP_NOPs makes exactly the limit
+        multisig = [0x00, 0x00, b'\x02', b'\x02', b'\x02', 0x53, 0xae]
+        self.assertTrue(Script([0x61] * (MAX_OPS_PER_SCRIPT - 4) + multisig).evaluate(0))
+        self.assertFalse(Script([0x61] * (MAX_OPS_PER_SCRIPT - 3) + multisig).evaluate(0))
+        # a negative key count fails before it is counted
+        self.assertFalse(Script([0x00, 0x00, 0x4f, 0xae]).evaluate(0))
+
+    def test_sigop_count(self):
+        self.assertEqual(p2pkh_script(bytes(20)).sigop_count(), 1)
+        multisig = Script([0x52, bytes(33), bytes(33), bytes(33), 0x53, 0xae])
+        self.assertEqual(multisig.sigop_count(), MAX_PUBKEYS_PER_MULTISIG)
+        self.assertEqual(multisig.sigop_count(accurate=True), 3)
+        self.assertEqual(Script([0xac, 0xad, 0xaf]).sigop_count(accurate=True), 22)
+        self.assertEqual(Script(raw=b'\x4c').sigop_count(), 0)
+
+    def test_evaluate_without_p2sh(self):
+        # OP_1 is a RedeemScript that passes, OP_0 one that fails
+        for redeem, valid in ((bytes([0x51]), True), (bytes([0x00]), False)):
+            script = Script([redeem, 0xa9, hash160(redeem), 0x87])
+            self.assertEqual(script.evaluate(0), valid)
+            # without p2sh only the hashes are compared
+            self.assertTrue(script.evaluate(0, p2sh=False))
+        # a RedeemScript shaped like p2sh is not run again
+        inner = bytes([0x00])
+        redeem = Script([0xa9, hash160(inner), 0x87]).raw_serialize()
+        self.assertTrue(Script([inner, redeem, 0xa9, hash160(redeem), 0x87]).evaluate(0))
+
+    def test_evaluate_bad_redeem_script(self):
+        # a RedeemScript whose push runs past its end
+        redeem = bytes.fromhex('4c05')
+        script = Script([redeem, 0xa9, hash160(redeem), 0x87])
+        self.assertFalse(script.evaluate(0))
+
+    def test_evaluate_p2sh(self):
+        # the RedeemScript OP_2 OP_3 OP_ADD OP_5 OP_EQUAL behind a p2sh ScriptPubKey
+        redeem = Script([0x52, 0x53, 0x93, 0x55, 0x87]).raw_serialize()
+        script_sig = Script([redeem])
+        self.assertTrue((script_sig + p2sh_script(hash160(redeem))).evaluate(0))
+        self.assertFalse((script_sig + p2sh_script(bytes(20))).evaluate(0))
+        self.assertFalse((Script([b'\x00' + redeem]) + p2sh_script(hash160(redeem))).evaluate(0))
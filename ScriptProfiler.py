@@ -0,0 +1,151 @@
+import json
+import time
+from unittest import TestCase
+
+from Operation import OP_CODE_NAMES
+
+# the profiler Script.evaluate reports to, None when profiling is off
+ACTIVE = None
+
+
+def enable(profiler=None):
+    '''
+    makes profiler (a new one by default) the global hook, returns it
+    '''
+    global ACTIVE
+    if profiler is None:
+        profiler = ScriptProfiler()
+    ACTIVE = profiler
+    return profiler
+
+
+def disable():
+    global ACTIVE
+    ACTIVE = None
+
+
+class ScriptProfiler:
+    '''
+    Per-opcode counts, cumulative wall time and stack depth high-water
+    marks for scripts run through Script.evaluate. Install it with enable()
+    or as a context manager:
+
+        with ScriptProfiler() as profiler:
+            tx.verify()
+        profiler.dump('profile.json')
+
+    The time of an instruction runs from its start to the start of the
+    next one, and its stack depth is counted, altstack included, right
+    after it ran.
+    '''
+
+    def __init__(self):
+        self.stats = {}
+        self.max_stack = 0
+        self.current = None
+        self.started = None
+        self.previous = None
+
+    def __enter__(self):
+        global ACTIVE
+        self.previous = ACTIVE
+        ACTIVE = self
+        return self
+
+    def __exit__(self, *exc):
+        global ACTIVE
+        ACTIVE = self.previous
+        self.previous = None
+
+    def step(self, cmd, depth):
+        '''
+        called right before each instruction, with the current stack depth
+        '''
+        now = time.perf_counter()
+        if self.started is not None:
+            self.record(self.current, now - self.started, depth)
+        self.current = cmd
+        self.started = time.perf_counter()
+
+    def finish(self, depth):
+        '''
+        closes the last instruction once a script stops running
+        '''
+        if self.started is not None:
+            self.record(self.current, time.perf_counter() - self.started, depth)
+        self.current = None
+        self.started = None
+
+    def record(self, cmd, elapsed, depth):
+        entry = self.stats.get(cmd)
+        if entry is None:
+            entry = self.stats[cmd] = [0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += elapsed
+        if depth > entry[2]:
+            entry[2] = depth
+        if depth > self.max_stack:
+            self.max_stack = depth
+
+    def results(self):
+        '''
+        returns {opcode name: {'count', 'time', 'max_stack'}}, pushes of
+        data are reported together as PUSHDATA
+        '''
+        results = {}
+        for cmd, (count, elapsed, depth) in self.stats.items():
+            if cmd is None:
+                name = 'PUSHDATA'
+            else:
+                name = OP_CODE_NAMES.get(cmd, 'OP_[{}]'.format(cmd))
+            results[name] = {'count': count, 'time': elapsed, 'max_stack': depth}
+        return results
+
+    def to_json(self):
+        return json.dumps({'max_stack': self.max_stack, 'opcodes': self.results()}, sort_keys=True, indent=4)
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_json())
+
+    def reset(self):
+        self.stats = {}
+        self.max_stack = 0
+        self.current = None
+        self.started = None
+
+
+class ScriptProfilerTest(TestCase):
+    def test_profile(self):
+        from Script import Script
+        # OP_2 OP_3 OP_ADD OP_5 OP_EQUAL
+        script = Script([0x52, 0x53, 0x93, 0x55, 0x87])
+        with ScriptProfiler() as profiler:
+            self.assertIs(ACTIVE, profiler)
+            self.assertTrue(script.evaluate(0))
+            self.assertTrue(script.evaluate(0))
+        self.assertIsNone(ACTIVE)
+        results = profiler.results()
+        self.assertEqual(results['OP_ADD']['count'], 2)
+        self.assertEqual(results['OP_ADD']['max_stack'], 1)
+        self.assertEqual(results['OP_3']['max_stack'], 2)
+        self.assertEqual(results['OP_EQUAL']['count'], 2)
+        self.assertEqual(profiler.max_stack, 2)
+        self.assertEqual(json.loads(profiler.to_json())['opcodes'], results)
+        script.evaluate(0)
+        self.assertEqual(profiler.results()['OP_ADD']['count'], 2)
+
+    def test_p2sh(self):
+        from Script import Script
+        from AddressCoder import hash160
+        redeem = Script([0x52, 0x93, 0x54, 0x87]).raw_serialize()
+        script = Script([0x52, redeem, 0xa9, hash160(redeem), 0x87])
+        profiler = enable()
+        try:
+            self.assertTrue(script.evaluate(0))
+        finally:
+            disable()
+        results = profiler.results()
+        self.assertEqual(results['OP_HASH160']['count'], 1)
+        self.assertEqual(results['OP_ADD']['count'], 1)
+        self.assertEqual(results['PUSHDATA']['count'], 1)
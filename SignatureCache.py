@@ -0,0 +1,129 @@
+import hashlib
+import os
+from unittest import TestCase
+
+from LRUCache import LRUCache
+from S256Field import SECP_256K1_P
+from Signature import Signature
+
+# number of verified signatures remembered by SIGNATURE_CACHE
+SIGNATURE_CACHE_SIZE = 100000
+
+
+class SignatureCache:
+    '''
+    Remembers (sighash, SEC pubkey, DER signature) triples that verified, so
+    a transaction checked in the mempool is not checked again when its
+    block arrives. Entries are keyed by a sha256 under a random per-process
+    salt, which keeps them small and stops anyone from precomputing keys
+    that collide. Pubkeys and signatures are normalized first, so the
+    raw stack bytes and re-encoded points and signatures share entries.
+    Only successful verifications are stored.
+    '''
+
+    def __init__(self, maxsize=SIGNATURE_CACHE_SIZE):
+        self.salted = hashlib.sha256(os.urandom(32))
+        self.entries = LRUCache(maxsize)
+
+    def __repr__(self):
+        return 'SignatureCache({}/{})'.format(len(self.entries), self.entries.maxsize)
+
+    def key(self, z, sec, der):
+        sec, der = normalize_sec(sec), normalize_der(der)
+        h = self.salted.copy()
+        h.update(z.to_bytes(32, 'big'))
+        # the length keeps the pubkey/signature boundary unambiguous
+        h.update(bytes([len(sec)]))
+        h.update(sec)
+        h.update(der)
+        return h.digest()
+
+    def contains(self, z, sec, der):
+        return self.entries.get(self.key(z, sec, der)) is not None
+
+    def add(self, z, sec, der):
+        self.entries.put(self.key(z, sec, der), True)
+
+    def resize(self, maxsize):
+        self.entries.resize(maxsize)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+
+def normalize_sec(sec):
+    '''
+    returns the compressed SEC of the point S256Point.parse reads from sec,
+    so a key verified in one encoding is found in the other; an
+    uncompressed key that parse would reject is returned as it is, since
+    the parity of its y alone would match the real key
+    '''
+    if len(sec) == 65 and sec[0] == 4:
+        x = int.from_bytes(sec[1:33], 'big')
+        y = int.from_bytes(sec[33:], 'big')
+        if x < SECP_256K1_P and y < SECP_256K1_P and (y * y - x ** 3 - 7) % SECP_256K1_P == 0:
+            return bytes([2 + (y & 1)]) + sec[1:33]
+        return sec
+    if len(sec) == 33 and sec[0] not in (2, 3):
+        # parse takes every other prefix for an odd y
+        return b'\x03' + sec[1:]
+    return sec
+
+
+def normalize_der(der):
+    '''
+    returns the canonical DER of the (r, s) Signature.parse reads from der,
+    or der itself when it does not parse to something der() can encode
+    '''
+    try:
+        return Signature.parse(der).der()
+    except (SyntaxError, IndexError, OverflowError):
+        return der
+
+
+SIGNATURE_CACHE = SignatureCache()
+
+
+class SignatureCacheTest(TestCase):
+    def test_cache(self):
+        cache = SignatureCache(maxsize=2)
+        sec = b'\x02' + bytes(32)
+        der = b'\x30\x06\x02\x01\x01\x02\x01\x01'
+        self.assertFalse(cache.contains(1, sec, der))
+        cache.add(1, sec, der)
+        self.assertTrue(cache.contains(1, sec, der))
+        self.assertFalse(cache.contains(2, sec, der))
+        self.assertFalse(cache.contains(1, sec[:-1], bytes(1) + der))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+    def test_normalized(self):
+        from PrivateKey import PrivateKey
+        point = PrivateKey(secret=8675309).point
+        sig = Signature(1, 0x80)
+        cache = SignatureCache()
+        # uncompressed pubkey, padded r
+        cache.add(1, point.sec(compressed=False), b'\x30\x08\x02\x02\x00\x01\x02\x02\x00\x80')
+        self.assertTrue(cache.contains(1, point.sec(), sig.der()))
+        self.assertFalse(cache.contains(1, point.sec(), Signature(1, 0x81).der()))
+        self.assertEqual(normalize_der(b'\x30'), b'\x30')
+
+    def test_off_curve(self):
+        from PrivateKey import PrivateKey
+        point = PrivateKey(secret=8675309).point
+        der = Signature(1, 1).der()
+        cache = SignatureCache()
+        cache.add(1, point.sec(), der)
+        # the real x with a made up y of the same parity is another key
+        y = point.y.num + 2
+        fake = b'\x04' + point.sec()[1:] + y.to_bytes(32, 'big')
+        self.assertEqual(normalize_sec(fake), fake)
+        self.assertFalse(cache.contains(1, fake, der))
+        self.assertTrue(cache.contains(1, point.sec(compressed=False), der))
+
+    def test_salt(self):
+        sec = b'\x02' + bytes(32)
+        self.assertNotEqual(SignatureCache().key(1, sec, b''), SignatureCache().key(1, sec, b''))
@@ -1,18 +1,42 @@
+import hashlib
 import json
 import requests
+import struct
 from unittest import TestCase
 from Crypto.Util.py3compat import BytesIO
 from io import BytesIO
-from AddressCoder import hash256, encode_varint, read_varint, decode_base58
+from AddressCoder import check_space, hash160, hash256, encode_varint, read_varint, decode_base58, varint_size, write_bytes, write_varint
+from LRUCache import LRUCache
+from Operation import verify_multisig, verify_signature
 from PrivateKey import PrivateKey
-from Script import Script, p2pkh_script
+from Script import MAX_SCRIPT_ELEMENT_SIZE, Script, p2pkh_script, p2sh_script
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
+
+# bounds of TransactionFetcher.cache: parsed transactions, and the total
+# of their serialized sizes
+TRANSACTION_CACHE_SIZE = 10000
+TRANSACTION_CACHE_BYTES = 64 * 1024 * 1024
 
 class Transaction:
+    '''
+    The serialized bytes and the hash are kept once computed, or taken
+    straight from the wire by parse. Assigning a field here, or on one of
+    the inputs or outputs, drops them; after changing the tx_ins or
+    tx_outs lists, a witness or a script's cmds in place, call
+    invalidate().
+    '''
+    # fields that make up the serialization
+    serialized_fields = ('version', 'tx_ins', 'tx_outs', 'lock_time')
+
     def __init__(self, version, tx_ins, tx_outs, lock_time, testnet=False):
+        self._serialized = None
+        self._hash = None
+        self._witness_hash = None
+        self._sighash = None
         self.version = version
         self.tx_ins = tx_ins
         self.tx_outs = tx_outs
@@ -34,6 +58,26 @@ class Transaction:
             self.lock_time
         )
 
+    def __setattr__(self, name, value):
+        if name in self.serialized_fields:
+            self.invalidate()
+            if name == 'tx_ins' or name == 'tx_outs':
+                for item in value:
+                    item.owner = self
+        object.__setattr__(self, name, value)
+
+    def invalidate(self, sighash=True):
+        '''
+        drops the cached serialization and hashes, and the sighash context
+        unless sighash is False, as for changes to scripts and witnesses
+        which signature hashes leave out
+        '''
+        self._serialized = None
+        self._hash = None
+        self._witness_hash = None
+        if sighash:
+            self._sighash = None
+
     def identifier(self):
         """
         Human-readable hexadecimal of the transaction.
@@ -42,26 +86,109 @@ class Transaction:
         return self.hash().hex()
 
     def hash(self):
-        return hash256(self.serialize())[::-1]
+        '''
+        the txid, which leaves the witness data out
+        '''
+        if self._hash is None:
+            self._hash = hash256(self.serialize(witness=False))[::-1]
+        return self._hash
 
-    def serialize(self):
-        result = self.version.to_bytes(4, 'little')
-        result += encode_varint(len(self.tx_ins))
+    def witness_hash(self):
+        '''
+        the wtxid, which commits to the witness data too
+        '''
+        if self._witness_hash is None:
+            if self.has_witness():
+                self._witness_hash = hash256(self.serialize())[::-1]
+            else:
+                self._witness_hash = self.hash()
+        return self._witness_hash
+
+    def witness_identifier(self):
+        return self.witness_hash().hex()
+
+    def has_witness(self):
+        for tx_in in self.tx_ins:
+            if tx_in.witness:
+                return True
+        return False
+
+    def size(self, witness=True):
+        '''
+        returns the length of the serialized transaction, with witness
+        False the length without the segwit marker, flag and witnesses
+        '''
+        total = 8 + varint_size(len(self.tx_ins)) + varint_size(len(self.tx_outs))
         for tx_in in self.tx_ins:
-            result += tx_in.serialize()
-        result += encode_varint(len(self.tx_outs))
+            total += tx_in.size()
         for tx_out in self.tx_outs:
-            result += tx_out.serialize()
-        result += self.lock_time.to_bytes(4, 'little')
-        return result
+            total += tx_out.size()
+        if witness and self.has_witness():
+            total += 2
+            for tx_in in self.tx_ins:
+                total += tx_in.witness_size()
+        return total
+
+    def serialize(self, witness=True):
+        '''
+        the wire format, BIP144 when any input has a witness; witness False
+        gives the serialization the txid commits to
+        '''
+        if witness or not self.has_witness():
+            if self._serialized is None:
+                buf = bytearray(self.size())
+                self.serialize_into(buf, 0)
+                self._serialized = bytes(buf)
+            return self._serialized
+        buf = bytearray(self.size(witness=False))
+        self.serialize_into(buf, 0, witness=False)
+        return bytes(buf)
+
+    def serialize_into(self, buf, offset, witness=True):
+        '''
+        writes the transaction into buf at offset, returns the offset just
+        past it, so a batch of transactions can share one buffer; raises
+        ValueError when buf is too short
+        '''
+        witness = witness and self.has_witness()
+        if self._serialized is not None and (witness or not self.has_witness()):
+            return write_bytes(buf, offset, self._serialized)
+        check_space(buf, offset, self.size(witness))
+        struct.pack_into('<I', buf, offset, self.version)
+        offset += 4
+        if witness:
+            offset = write_bytes(buf, offset, b'\x00\x01')
+        offset = write_varint(buf, offset, len(self.tx_ins))
+        for tx_in in self.tx_ins:
+            offset = tx_in.serialize_into(buf, offset)
+        offset = write_varint(buf, offset, len(self.tx_outs))
+        for tx_out in self.tx_outs:
+            offset = tx_out.serialize_into(buf, offset)
+        if witness:
+            for tx_in in self.tx_ins:
+                offset = tx_in.witness_serialize_into(buf, offset)
+        struct.pack_into('<I', buf, offset, self.lock_time)
+        return offset + 4
 
     @classmethod
     def parse(cls, s, testnet=False):
         '''Takes a byte stream and parses the transaction at the start
         return a Tx object
         '''
+        try:
+            start = s.tell()
+        except (AttributeError, OSError):
+            # a stream we cannot seek back in, the bytes get rebuilt
+            start = None
         version = int.from_bytes(s.read(4), 'little')
         num_inputs = read_varint(s)
+        segwit = num_inputs == 0
+        if segwit:
+            # BIP144: the 0 marker, where the input count would be, and a flag
+            flag = s.read(1)
+            if flag != b'\x01':
+                raise SyntaxError('unknown segwit flag: {}'.format(flag.hex()))
+            num_inputs = read_varint(s)
         inputs = []
         for _ in range(num_inputs):
             inputs.append(TransactionInput.parse(s))
@@ -71,8 +198,20 @@ class Transaction:
         for _ in range(num_outputs):
             outputs.append(TransactionOutput.parse(s))
 
+        if segwit:
+            for tx_in in inputs:
+                tx_in.witness = [s.read(read_varint(s)) for _ in range(read_varint(s))]
+            if not any(tx_in.witness for tx_in in inputs):
+                # the marker without a witness would serialize differently
+                # from the bytes read, as the reference client also refuses
+                raise SyntaxError('superfluous witness record')
         lock_time = int.from_bytes(s.read(4), 'little')
-        return cls(version, inputs, outputs, lock_time, testnet)
+        tx = cls(version, inputs, outputs, lock_time, testnet)
+        if start is not None:
+            end = s.tell()
+            s.seek(start)
+            tx._serialized = s.read(end - start)
+        return tx
 
     def fee(self):
         input_total = 0
@@ -83,45 +222,176 @@ class Transaction:
             output_total += tx_out.amount
         return input_total - output_total
 
-    def sig_hash(self, input_index, redeem_script=None):
-        target_stream = self.version.to_bytes(4, 'little')
-        target_stream += encode_varint(len(self.tx_ins))
-        for i, tx_in in enumerate(self.tx_ins):
-            if i == input_index:
-                if redeem_script:
-                    script_sig = redeem_script
-                else:
-                    script_sig = tx_in.script_pubkey(self.testnet)
-            else:
-                script_sig = None
-            target_stream += TransactionInput(
-                prev_tx=tx_in.prev_tx,
-                prev_index=tx_in.prev_index,
-                script_sig=script_sig,
-                sequence=tx_in.sequence,
-            ).serialize()
-        target_stream += encode_varint(len(self.tx_outs))
+    def sigop_count(self, p2sh=False):
+        '''
+        Counts the signature checks the transaction's scripts can make,
+        without running them, so expensive transactions can be turned away
+        before any EC work. With p2sh the RedeemScripts of p2sh inputs are
+        counted too, which looks up the previous outputs.
+        '''
+        count = 0
+        for tx_in in self.tx_ins:
+            count += tx_in.script_sig.sigop_count()
         for tx_out in self.tx_outs:
-            target_stream += tx_out.serialize()
+            count += tx_out.script_pubkey.sigop_count()
+        if p2sh and not self.is_coinbase():
+            for tx_in in self.tx_ins:
+                if not tx_in.script_pubkey(self.testnet).is_p2sh_script_pubkey():
+                    continue
+                try:
+                    cmds = tx_in.script_sig.cmds
+                except SyntaxError:
+                    continue
+                if cmds and type(cmds[-1]) == bytes:
+                    count += Script(raw=cmds[-1]).sigop_count(accurate=True)
+        return count
+
+    def sighash_context(self):
+        '''
+        returns the SighashContext shared by all inputs, built the first
+        time a signature hash is needed and dropped by invalidate()
+        '''
+        if self._sighash is None:
+            self._sighash = SighashContext(self)
+        return self._sighash
+
+    def sig_hash(self, input_index, redeem_script=None, hash_type=SIGHASH_ALL):
+        if redeem_script:
+            script_code = redeem_script
+        else:
+            script_code = self.tx_ins[input_index].script_pubkey(self.testnet)
+        return self.sighash_context().sig_hash(input_index, script_code, hash_type)
 
-        target_stream += self.lock_time.to_bytes(4, 'little')
-        target_stream += SIGHASH_ALL.to_bytes(4, 'little')
-        h256 = hash256(target_stream)
-        return int.from_bytes(h256, 'big')
+    def sig_hash_bip143(self, input_index, redeem_script=None, witness_script=None, hash_type=SIGHASH_ALL):
+        '''
+        returns the BIP143 signature hash of a segwit input; p2wpkh, native
+        or nested in the p2sh redeem_script, signs as the matching p2pkh,
+        p2wsh signs its witness_script
+        '''
+        tx_in = self.tx_ins[input_index]
+        if witness_script is not None:
+            script_code = witness_script
+        else:
+            if redeem_script is not None:
+                program = redeem_script
+            else:
+                program = tx_in.script_pubkey(self.testnet)
+            script_code = p2pkh_script(program.cmds[1])
+        amount = tx_in.value(self.testnet)
+        return self.sighash_context().segwit_sig_hash(input_index, script_code, amount, hash_type)
 
     def verify_input(self, input_index):
         tx_in = self.tx_ins[input_index]
         script_pubkey = tx_in.script_pubkey(testnet=self.testnet)
+        try:
+            if script_pubkey.is_p2sh_script_pubkey():
+                # the last cmd in a p2sh is the RedeemScript, which has to
+                # be a push
+                cmds = tx_in.script_sig.cmds
+                if not cmds or type(cmds[-1]) != bytes:
+                    return False
+                redeem_script = Script(raw=cmds[-1])
+                program = redeem_script
+            else:
+                redeem_script = None
+                program = script_pubkey
+            if program.is_p2wpkh_script_pubkey() or program.is_p2wsh_script_pubkey():
+                return self.verify_witness_input(input_index, script_pubkey, redeem_script)
+            result = self.verify_standard_input(input_index, script_pubkey, redeem_script)
+            if result is not None:
+                return result
+            combined = tx_in.script_sig + script_pubkey
+            # every signature is checked against the hash of its own type
+            return combined.evaluate(lambda hash_type: self.sig_hash(input_index, redeem_script, hash_type))
+        except (SyntaxError, IndexError):
+            # scripts are tokenized lazily, so this is where a malformed
+            # one shows up
+            return False
+
+    def verify_witness_input(self, input_index, script_pubkey, redeem_script=None):
+        '''
+        Validates p2wpkh and p2wsh inputs, native or nested in p2sh, against
+        their witness and the BIP143 signature hash. Witness scripts run in
+        the interpreter.
+        '''
+        tx_in = self.tx_ins[input_index]
+        if redeem_script is None:
+            # native segwit leaves the ScriptSig empty
+            if tx_in.script_sig.raw_size() != 0:
+                return False
+            program = script_pubkey
+        else:
+            cmds = tx_in.script_sig.cmds
+            if len(cmds) != 1 or hash160(cmds[0]) != script_pubkey.cmds[1]:
+                return False
+            program = redeem_script
+        witness = tx_in.witness
+        if program.is_p2wpkh_script_pubkey():
+            if len(witness) != 2:
+                return False
+            signature, sec = witness
+            if hash160(sec) != program.cmds[1]:
+                return False
+            try:
+                z = self.sig_hash_bip143(input_index, redeem_script, hash_type=signature[-1])
+                return verify_signature(sec, signature, z)
+            except (ValueError, SyntaxError, IndexError):
+                return False
+        if not witness or hashlib.sha256(witness[-1]).digest() != program.cmds[1]:
+            return False
+        witness_script = Script(raw=witness[-1])
+        def z(hash_type):
+            return self.sig_hash_bip143(input_index, witness_script=witness_script, hash_type=hash_type)
+        # witness scripts are not subject to the p2sh rule
+        return Script(list(witness[:-1]) + list(witness_script.cmds)).evaluate(z, p2sh=False)
+
+    def verify_standard_input(self, input_index, script_pubkey, redeem_script=None):
+        '''
+        Validates p2pkh and bare or p2sh multisig inputs without the script
+        interpreter. The hash160 commitments are compared before any EC work.
+        Returns None when the input does not follow one of these templates,
+        or pushes anything the interpreter would reject as too large.
+        '''
+        cmds = self.tx_ins[input_index].script_sig.cmds
+        for cmd in cmds:
+            if type(cmd) == bytes and len(cmd) > MAX_SCRIPT_ELEMENT_SIZE:
+                return None
+        if script_pubkey.is_p2pkh_script_pubkey():
+            if len(cmds) != 2 or type(cmds[0]) != bytes or type(cmds[1]) != bytes:
+                return None
+            signature, sec = cmds
+            if hash160(sec) != script_pubkey.cmds[2]:
+                return False
+            try:
+                z = self.sig_hash(input_index, hash_type=signature[-1])
+                return verify_signature(sec, signature, z)
+            except (ValueError, SyntaxError, IndexError):
+                return False
         if script_pubkey.is_p2sh_script_pubkey():
-            # the last cmd in a p2sh is the RedeemScript
-            cmd = tx_in.script_sig.cmds[-1]
-            raw_redeem = encode_varint(len(cmd)) + cmd
-            redeem_script = Script.parse(BytesIO(raw_redeem))
+            if redeem_script is None or not redeem_script.is_multisig_script():
+                return None
+            multisig = redeem_script
+            signatures = cmds[1:-1]
+        elif script_pubkey.is_multisig_script():
+            multisig = script_pubkey
+            signatures = cmds[1:]
         else:
-            redeem_script = None
-        tx_hash = self.sig_hash(input_index, redeem_script)
-        combined = tx_in.script_sig + script_pubkey
-        return combined.evaluate(tx_hash)
+            return None
+        for cmd in multisig.cmds:
+            if type(cmd) == bytes and len(cmd) > MAX_SCRIPT_ELEMENT_SIZE:
+                return None
+        # OP_0 <signature> ... <signature> [<RedeemScript>]
+        if not cmds or cmds[0] != 0 or any(type(sig) != bytes for sig in signatures):
+            return None
+        if len(signatures) != multisig.cmds[0] - 0x50:
+            return None
+        if redeem_script is not None and hash160(cmds[-1]) != script_pubkey.cmds[1]:
+            return False
+        try:
+            return verify_multisig(multisig.cmds[1:-2], signatures,
+                                   lambda hash_type: self.sig_hash(input_index, redeem_script, hash_type))
+        except (ValueError, SyntaxError, IndexError):
+            return False
 
     def verify(self):
         if self.fee() < 0:
@@ -131,11 +401,11 @@ class Transaction:
                 return False
         return True
 
-    def sign_input(self, input_index, private_key):
+    def sign_input(self, input_index, private_key, hash_type=SIGHASH_ALL):
         '''Signs the input using the private key'''
-        z = self.sig_hash(input_index)
+        z = self.sig_hash(input_index, hash_type=hash_type)
         der = private_key.sign(z).der()
-        sig = der + SIGHASH_ALL.to_bytes(1, 'big')
+        sig = der + hash_type.to_bytes(1, 'big')
         sec_pubkey = private_key.point.sec()
         script_sig = Script([sig, sec_pubkey])
         self.tx_ins[input_index].script_sig = script_sig
@@ -158,8 +428,162 @@ class Transaction:
         return int.from_bytes(first_cmd, 'little')
 
 
+class SighashContext:
+    '''
+    Builds legacy signature hash preimages from pieces serialized once per
+    transaction instead of rebuilding the whole transaction for every
+    input. The inputs before the one being signed are the same for every
+    input after them, so the sha256 state after each of them is kept and
+    copied rather than hashed again. BIP143 preimages reuse the same
+    pieces and three digests of them.
+    '''
+
+    # an output blanked by SIGHASH_SINGLE: amount -1 and an empty script
+    null_output = b'\xff' * 8 + b'\x00'
+
+    def __init__(self, tx):
+        self.version = struct.pack('<I', tx.version)
+        self.lock_time = struct.pack('<I', tx.lock_time)
+        self.input_count = encode_varint(len(tx.tx_ins))
+        self.outpoints = [tx_in.prev_tx[::-1] + struct.pack('<I', tx_in.prev_index) for tx_in in tx.tx_ins]
+        self.sequences = [struct.pack('<I', tx_in.sequence) for tx_in in tx.tx_ins]
+        self.outputs = [tx_out.serialize() for tx_out in tx.tx_outs]
+        self.all_outputs = encode_varint(len(self.outputs)) + b''.join(self.outputs)
+        # per sequence handling: the inputs with empty scripts, and the
+        # sha256 states after each of them
+        self.blanked = {}
+        self.midstates = {}
+        # BIP143 digests, shared by every segwit input
+        self._hash_prevouts = None
+        self._hash_sequence = None
+        self._hash_outputs = None
+
+    def blanked_inputs(self, zero_sequences):
+        '''
+        returns every input serialized with an empty script, 41 bytes each,
+        with their own sequences or, for SIGHASH_NONE and SIGHASH_SINGLE,
+        with 0
+        '''
+        if zero_sequences not in self.blanked:
+            if zero_sequences:
+                sequences = [bytes(4)] * len(self.outpoints)
+            else:
+                sequences = self.sequences
+            self.blanked[zero_sequences] = memoryview(b''.join(
+                outpoint + b'\x00' + sequence for outpoint, sequence in zip(self.outpoints, sequences)))
+        return self.blanked[zero_sequences]
+
+    def midstate(self, zero_sequences, input_index):
+        '''
+        returns a sha256 that has seen the preimage up to the input at
+        input_index
+        '''
+        states = self.midstates.get(zero_sequences)
+        if states is None:
+            blanked = self.blanked_inputs(zero_sequences)
+            h = hashlib.sha256(self.version + self.input_count)
+            states = []
+            for i in range(len(self.outpoints)):
+                states.append(h.copy())
+                h.update(blanked[i * 41:(i + 1) * 41])
+            self.midstates[zero_sequences] = states
+        return states[input_index].copy()
+
+    def hash_prevouts(self):
+        if self._hash_prevouts is None:
+            self._hash_prevouts = hash256(b''.join(self.outpoints))
+        return self._hash_prevouts
+
+    def hash_sequence(self):
+        if self._hash_sequence is None:
+            self._hash_sequence = hash256(b''.join(self.sequences))
+        return self._hash_sequence
+
+    def hash_outputs(self):
+        if self._hash_outputs is None:
+            self._hash_outputs = hash256(b''.join(self.outputs))
+        return self._hash_outputs
+
+    def segwit_sig_hash(self, input_index, script_code, amount, hash_type=SIGHASH_ALL):
+        '''
+        returns the BIP143 signature hash of the input at input_index, which
+        spends amount, as an int; hashPrevouts, hashSequence and hashOutputs
+        are computed once for all inputs
+        '''
+        base_type = hash_type & 0x1f
+        anyone_can_pay = hash_type & SIGHASH_ANYONECANPAY
+        if anyone_can_pay:
+            hash_prevouts = bytes(32)
+        else:
+            hash_prevouts = self.hash_prevouts()
+        if anyone_can_pay or base_type == SIGHASH_NONE or base_type == SIGHASH_SINGLE:
+            hash_sequence = bytes(32)
+        else:
+            hash_sequence = self.hash_sequence()
+        if base_type == SIGHASH_SINGLE:
+            if input_index < len(self.outputs):
+                hash_outputs = hash256(self.outputs[input_index])
+            else:
+                hash_outputs = bytes(32)
+        elif base_type == SIGHASH_NONE:
+            hash_outputs = bytes(32)
+        else:
+            hash_outputs = self.hash_outputs()
+        preimage = b''.join((
+            self.version,
+            hash_prevouts,
+            hash_sequence,
+            self.outpoints[input_index],
+            script_code.serialize(),
+            struct.pack('<Q', amount),
+            self.sequences[input_index],
+            hash_outputs,
+            self.lock_time,
+            struct.pack('<I', hash_type),
+        ))
+        return int.from_bytes(hash256(preimage), 'big')
+
+    def sig_hash(self, input_index, script_code, hash_type=SIGHASH_ALL):
+        '''
+        returns the signature hash of the input at input_index, as an int,
+        with script_code (a Script) standing in for its ScriptSig
+        '''
+        base_type = hash_type & 0x1f
+        if base_type == SIGHASH_SINGLE and input_index >= len(self.outputs):
+            # there is no output to commit to, consensus signs the number 1
+            # instead (stored little endian)
+            return 1 << 248
+        zero_sequences = base_type == SIGHASH_NONE or base_type == SIGHASH_SINGLE
+        if hash_type & SIGHASH_ANYONECANPAY:
+            h = hashlib.sha256(self.version + b'\x01')
+        else:
+            h = self.midstate(zero_sequences, input_index)
+        h.update(self.outpoints[input_index])
+        h.update(script_code.serialize())
+        h.update(self.sequences[input_index])
+        if not hash_type & SIGHASH_ANYONECANPAY:
+            h.update(self.blanked_inputs(zero_sequences)[(input_index + 1) * 41:])
+        if base_type == SIGHASH_NONE:
+            h.update(b'\x00')
+        elif base_type == SIGHASH_SINGLE:
+            h.update(encode_varint(input_index + 1))
+            h.update(self.null_output * input_index)
+            h.update(self.outputs[input_index])
+        else:
+            h.update(self.all_outputs)
+        h.update(self.lock_time)
+        h.update(struct.pack('<I', hash_type))
+        return int.from_bytes(hashlib.sha256(h.digest()).digest(), 'big')
+
+
 class TransactionInput:
-    def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff):
+    serialized_fields = ('prev_tx', 'prev_index', 'script_sig', 'sequence', 'witness')
+    # fields that no signature hash covers
+    unsigned_fields = ('script_sig', 'witness')
+
+    def __init__(self, prev_tx, prev_index, script_sig=None, sequence=0xffffffff, witness=None):
+        # the Transaction whose cached serialization this is part of
+        self.owner = None
         self.prev_tx = prev_tx
         self.prev_index = prev_index
         if script_sig is None:
@@ -167,10 +591,20 @@ class TransactionInput:
         else:
             self.script_sig = script_sig
         self.sequence = sequence
+        # the witness stack, a list of byte strings, empty for legacy inputs
+        if witness is None:
+            self.witness = []
+        else:
+            self.witness = witness
 
     def __repr__(self):
         return '{}:{}'.format(self.prev_tx.hex(), self.prev_index)
 
+    def __setattr__(self, name, value):
+        if name in self.serialized_fields and self.owner is not None:
+            self.owner.invalidate(sighash=name not in self.unsigned_fields)
+        object.__setattr__(self, name, value)
+
     def fetch_transactions(self, testnet=False):
         return TransactionFetcher.fetch(self.prev_tx.hex(), testnet)
 
@@ -186,12 +620,33 @@ class TransactionInput:
         tx = self.fetch_transactions(testnet=testnet)
         return tx.tx_outs[self.prev_index].script_pubkey
 
+    def size(self):
+        return 40 + self.script_sig.size()
+
     def serialize(self):
-        result = self.prev_tx[::-1]
-        result += self.prev_index.to_bytes(4, 'little')
-        result += self.script_sig.serialize()
-        result += self.sequence.to_bytes(4, 'little')
-        return result
+        buf = bytearray(self.size())
+        self.serialize_into(buf, 0)
+        return bytes(buf)
+
+    def serialize_into(self, buf, offset):
+        write_bytes(buf, offset, self.prev_tx[::-1])
+        struct.pack_into('<I', buf, offset + 32, self.prev_index)
+        offset = self.script_sig.serialize_into(buf, offset + 36)
+        struct.pack_into('<I', buf, offset, self.sequence)
+        return offset + 4
+
+    def witness_size(self):
+        total = varint_size(len(self.witness))
+        for item in self.witness:
+            total += varint_size(len(item)) + len(item)
+        return total
+
+    def witness_serialize_into(self, buf, offset):
+        offset = write_varint(buf, offset, len(self.witness))
+        for item in self.witness:
+            offset = write_varint(buf, offset, len(item))
+            offset = write_bytes(buf, offset, item)
+        return offset
 
     @classmethod
     def parse(cls, s):
@@ -203,27 +658,47 @@ class TransactionInput:
 
 
 class TransactionOutput:
+    serialized_fields = ('amount', 'script_pubkey')
+
     def __init__(self, amount, script_pubkey):
+        # the Transaction whose cached serialization this is part of
+        self.owner = None
         self.amount = amount
         self.script_pubkey = script_pubkey
 
     def __repr__(self):
         return '{}:{}'.format(self.amount, self.script_pubkey)
 
+    def __setattr__(self, name, value):
+        if name in self.serialized_fields and self.owner is not None:
+            self.owner.invalidate()
+        object.__setattr__(self, name, value)
+
     @classmethod
     def parse(cls, s):
         amount = int.from_bytes(s.read(8), 'little')
         script_pubkey = Script.parse(s)
         return cls(amount, script_pubkey)
 
+    def size(self):
+        return 8 + self.script_pubkey.size()
+
     def serialize(self):
-        result = self.amount.to_bytes(8, 'little')
-        result += self.script_pubkey.serialize()
-        return result
+        buf = bytearray(self.size())
+        self.serialize_into(buf, 0)
+        return bytes(buf)
+
+    def serialize_into(self, buf, offset):
+        struct.pack_into('<Q', buf, offset, self.amount)
+        return self.script_pubkey.serialize_into(buf, offset + 8)
 
 
 class TransactionFetcher:
-    cache = {}
+    # parsed transactions by id; pin() the ones that must stay, resize()
+    # to change the bounds
+    cache = LRUCache(TRANSACTION_CACHE_SIZE, TRANSACTION_CACHE_BYTES, sizeof=lambda tx: len(tx.serialize()))
+    # a TransactionStore consulted before the network, see use_store
+    store = None
 
     @classmethod
     def get_url(cls, testnet=False):
@@ -232,41 +707,46 @@ class TransactionFetcher:
         else:
             return 'https://blockstream.info/api'
 
+    @classmethod
+    def use_store(cls, store):
+        '''
+        makes fetch look transactions up in store, a TransactionStore,
+        before going to the network, and keep what it downloads there
+        '''
+        cls.store = store
+
     @classmethod
     def fetch(cls, tx_id, testnet=False, fresh=False):
-        if fresh or (tx_id not in cls.cache):
+        tx = None
+        if not fresh:
+            tx = cls.cache.get(tx_id)
+            if tx is None and cls.store is not None:
+                tx = cls.store.get(tx_id, testnet=testnet)
+                if tx is not None:
+                    cls.cache.put(tx_id, tx)
+        if tx is None:
             url = '{}/tx/{}/hex'.format(cls.get_url(testnet), tx_id)
             response = requests.get(url)
             try:
                 raw = bytes.fromhex(response.text.strip())
             except ValueError:
                 raise ValueError('unexpected response: {}'.format(response.text))
+            tx = Transaction.parse(BytesIO(raw), testnet=testnet)
             # make sure the tx we got matches to the hash we requested
-            if raw[4] == 0:
-                raw = raw[:4] + raw[6:]
-                tx = Transaction.parse(BytesIO(raw), testnet=testnet)
-                tx.lock_time = int.from_bytes(raw[-4:], 'little')
-            else:
-                tx = Transaction.parse(BytesIO(raw), testnet=testnet)
             if tx.identifier() != tx_id:
                 raise ValueError('not the same id: {} vs {}'.format(tx.identifier(), tx_id))
-            cls.cache[tx_id] = tx
-        cls.cache[tx_id].testnet = testnet
-        return cls.cache[tx_id]
+            cls.cache.put(tx_id, tx)
+            if cls.store is not None:
+                cls.store.put_raw(tx_id, raw)
+        tx.testnet = testnet
+        return tx
 
     @classmethod
     def load_cache(cls, filename):
         cache_file = open(filename, 'r')
         disk_cache = json.loads(cache_file.read())
         for k, raw_hex in disk_cache.items():
-            raw = bytes.fromhex(raw_hex)
-            if raw[4] == 0:
-                raw = raw[:4] + raw[6:]
-                tx = Transaction.parse(BytesIO(raw))
-                tx.lock_time = int.from_bytes(raw[-4:], 'little')
-            else:
-                tx = Transaction.parse(BytesIO(raw))
-            cls.cache[k] = tx
+            cls.cache.put(k, Transaction.parse(BytesIO(bytes.fromhex(raw_hex))))
         cache_file.close()
 
     @classmethod
@@ -352,6 +832,23 @@ class TransactionTest(TestCase):
         stream = BytesIO(raw_tx)
         tx = Transaction.parse(stream)
         self.assertEqual(tx.serialize(), raw_tx)
+        self.assertEqual(tx.size(), len(raw_tx))
+        # rebuilt scripts serialize the same as the parsed bytes
+        for tx_in in tx.tx_ins:
+            tx_in.script_sig.cmds = list(tx_in.script_sig.cmds)
+        self.assertEqual(tx.serialize(), raw_tx)
+        buf = bytearray(2 * len(raw_tx))
+        offset = tx.serialize_into(buf, 0)
+        self.assertEqual(tx.serialize_into(buf, offset), len(buf))
+        self.assertEqual(bytes(buf), raw_tx + raw_tx)
+        # a short buffer raises, cached serialization or not
+        for short in (bytearray(len(raw_tx) - 1), bytearray(40)):
+            with self.assertRaises(ValueError):
+                tx.serialize_into(short, 0)
+            tx.invalidate()
+            with self.assertRaises(ValueError):
+                tx.serialize_into(short, 0)
+        self.assertEqual(len(short), 40)
 
     def test_input_value(self):
         tx_hash = 'd1c789a9c60383bf715f3f6ad9d14b91fe55f3deb369fe5d9280cb1a01793f81'
@@ -382,14 +879,258 @@ class TransactionTest(TestCase):
         tx = TransactionFetcher.fetch('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
         self.assertTrue(tx.verify())
 
+    def test_verify_standard_input_limits(self):
+        stream = BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'))
+        tx = Transaction.parse(stream, testnet=True)
+        # 16-of-16 with uncompressed keys: a RedeemScript over 520 bytes
+        keys = [PrivateKey(secret=i + 1) for i in range(16)]
+        redeem_script = Script([0x60] + [key.point.sec(compressed=False) for key in keys] + [0x60, 0xae])
+        raw_redeem = redeem_script.raw_serialize()
+        self.assertGreater(len(raw_redeem), MAX_SCRIPT_ELEMENT_SIZE)
+        script_pubkey = p2sh_script(hash160(raw_redeem))
+        z = tx.sig_hash(0, redeem_script)
+        signatures = [key.sign(z).der() + SIGHASH_ALL.to_bytes(1, 'big') for key in keys]
+        tx.tx_ins[0].script_sig = Script([0x00] + signatures + [raw_redeem])
+        self.assertIsNone(tx.verify_standard_input(0, script_pubkey, redeem_script))
+        self.assertFalse((tx.tx_ins[0].script_sig + script_pubkey).evaluate(z))
+        # the same keys within the limit pass both ways
+        redeem_script = Script([0x52] + [key.point.sec() for key in keys[:2]] + [0x52, 0xae])
+        raw_redeem = redeem_script.raw_serialize()
+        script_pubkey = p2sh_script(hash160(raw_redeem))
+        z = tx.sig_hash(0, redeem_script)
+        signatures = [key.sign(z).der() + SIGHASH_ALL.to_bytes(1, 'big') for key in keys[:2]]
+        tx.tx_ins[0].script_sig = Script([0x00] + signatures + [raw_redeem])
+        self.assertTrue(tx.verify_standard_input(0, script_pubkey, redeem_script))
+        self.assertTrue((tx.tx_ins[0].script_sig + script_pubkey).evaluate(z))
+
+    def test_verify_bad_redeem_script(self):
+        tx = TransactionFetcher.fetch('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
+        script_sig = tx.tx_ins[0].script_sig
+        try:
+            tx.tx_ins[0].script_sig = Script([0x00, bytes.fromhex('4c05')])
+            self.assertFalse(tx.verify_input(0))
+            # a ScriptSig ending in an opcode, or empty, has no RedeemScript
+            for cmds in ([0x00, 0x51], []):
+                tx.tx_ins[0].script_sig = Script(cmds)
+                self.assertFalse(tx.verify_input(0))
+        finally:
+            tx.tx_ins[0].script_sig = script_sig
+
+    def test_verify_standard_input(self):
+        for tx_id in ('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03',
+                      '46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b'):
+            tx = TransactionFetcher.fetch(tx_id)
+            tx_in = tx.tx_ins[0]
+            script_pubkey = tx_in.script_pubkey()
+            redeem_script = None
+            if script_pubkey.is_p2sh_script_pubkey():
+                cmd = tx_in.script_sig.cmds[-1]
+                redeem_script = Script.parse(BytesIO(encode_varint(len(cmd)) + cmd))
+            self.assertTrue(tx.verify_standard_input(0, script_pubkey, redeem_script))
+            z = tx.sig_hash(0, redeem_script)
+            self.assertTrue((tx_in.script_sig + script_pubkey).evaluate(z))
+            # a wrong hash160 is rejected before any signature check
+            tampered = Script([0xa9, bytes(20), 0x87]) if redeem_script else p2pkh_script(bytes(20))
+            self.assertFalse(tx.verify_standard_input(0, tampered, redeem_script))
+        self.assertIsNone(tx.verify_standard_input(0, Script([0x51]), None))
+
+    def test_parse_superfluous_witness(self):
+        raw = bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')
+        # the marker and flag, then one empty witness before the lock time
+        marked = raw[:4] + b'\x00\x01' + raw[4:-4] + b'\x00' + raw[-4:]
+        with self.assertRaises(SyntaxError):
+            Transaction.parse(BytesIO(marked))
+        self.assertEqual(Transaction.parse(BytesIO(raw)).serialize(), raw)
+
+    def test_cached_serialization(self):
+        raw_tx = bytes.fromhex('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
+        stream = BytesIO(b'\x00' + raw_tx + b'\x00')
+        stream.read(1)
+        tx = Transaction.parse(stream)
+        self.assertEqual(stream.read(), b'\x00')
+        self.assertEqual(tx._serialized, raw_tx)
+        self.assertIs(tx.serialize(), tx.serialize())
+        self.assertIs(tx.hash(), tx.hash())
+        identifier = tx.identifier()
+        tx.tx_outs[0].amount += 1
+        self.assertIsNone(tx._serialized)
+        self.assertNotEqual(tx.identifier(), identifier)
+        tx.tx_outs[0].amount -= 1
+        self.assertEqual(tx.identifier(), identifier)
+        tx.lock_time = 0
+        self.assertNotEqual(tx.identifier(), identifier)
+
+    def test_sig_hash_types(self):
+        tx = Transaction.parse(BytesIO(bytes.fromhex('010000000456919960ac691763688d3d3bcea9ad6ecaf875df5339e148a1fc61c6ed7a069e010000006a47304402204585bcdef85e6b1c6af5c2669d4830ff86e42dd205c0e089bc2a821657e951c002201024a10366077f87d6bce1f7100ad8cfa8a064b39d4e8fe4ea13a7b71aa8180f012102f0da57e85eec2934a82a585ea337ce2f4998b50ae699dd79f5880e253dafafb7feffffffeb8f51f4038dc17e6313cf831d4f02281c2a468bde0fafd37f1bf882729e7fd3000000006a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937feffffff567bf40595119d1bb8a3037c356efd56170b64cbcc160fb028fa10704b45d775000000006a47304402204c7c7818424c7f7911da6cddc59655a70af1cb5eaf17c69dadbfc74ffa0b662f02207599e08bc8023693ad4e9527dc42c34210f7a7d1d1ddfc8492b654a11e7620a0012102158b46fbdff65d0172b7989aec8850aa0dae49abfb84c81ae6e5b251a58ace5cfeffffffd63a5e6c16e620f86f375925b21cabaf736c779f88fd04dcad51d26690f7f345010000006a47304402200633ea0d3314bea0d95b3cd8dadb2ef79ea8331ffe1e61f762c0f6daea0fabde022029f23b3e9c30f080446150b23852028751635dcee2be669c2a1686a4b5edf304012103ffd6f4a67e94aba353a00882e563ff2722eb4cff0ad6006e86ee20dfe7520d55feffffff0251430f00000000001976a914ab0c0b2e98b1ab6dbf67d4750b0a56244948a87988ac005a6202000000001976a9143c82d7df364eb6c75be8c80df2b3eda8db57397088ac46430600')))
+        script_code = p2pkh_script(bytes(20))
+
+        def reference(input_index, hash_type):
+            # the transaction copy consensus hashes, built the slow way
+            base_type = hash_type & 0x1f
+            tx_ins = []
+            for i, tx_in in enumerate(tx.tx_ins):
+                if i == input_index:
+                    tx_ins.append(TransactionInput(tx_in.prev_tx, tx_in.prev_index, script_code, tx_in.sequence))
+                elif not hash_type & SIGHASH_ANYONECANPAY:
+                    sequence = 0 if base_type in (SIGHASH_NONE, SIGHASH_SINGLE) else tx_in.sequence
+                    tx_ins.append(TransactionInput(tx_in.prev_tx, tx_in.prev_index, None, sequence))
+            if base_type == SIGHASH_NONE:
+                tx_outs = []
+            elif base_type == SIGHASH_SINGLE:
+                tx_outs = [TransactionOutput(2**64 - 1, Script()) for _ in range(input_index)]
+                tx_outs.append(tx.tx_outs[input_index])
+            else:
+                tx_outs = tx.tx_outs
+            copy = Transaction(tx.version, tx_ins, tx_outs, tx.lock_time)
+            return int.from_bytes(hash256(copy.serialize() + hash_type.to_bytes(4, 'little')), 'big')
+
+        context = tx.sighash_context()
+        for base_type in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE):
+            for hash_type in (base_type, base_type | SIGHASH_ANYONECANPAY):
+                for i in range(len(tx.tx_ins)):
+                    if base_type == SIGHASH_SINGLE and i >= len(tx.tx_outs):
+                        self.assertEqual(context.sig_hash(i, script_code, hash_type), 1 << 248)
+                    else:
+                        self.assertEqual(context.sig_hash(i, script_code, hash_type), reference(i, hash_type))
+        self.assertIs(tx.sighash_context(), context)
+        tx.lock_time += 1
+        self.assertIsNot(tx.sighash_context(), context)
+
+    def test_parse_segwit(self):
+        tx = TransactionFetcher.fetch('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c', testnet=True)
+        self.assertTrue(tx.has_witness())
+        self.assertEqual(len(tx.tx_ins[0].witness), 2)
+        self.assertEqual(tx.identifier(), 'd869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c')
+        self.assertNotEqual(tx.witness_identifier(), tx.identifier())
+        raw = tx.serialize()
+        self.assertEqual(raw[4:6], b'\x00\x01')
+        self.assertEqual(len(raw), tx.size())
+        self.assertEqual(len(tx.serialize(witness=False)), tx.size(witness=False))
+        tx.invalidate()
+        self.assertEqual(tx.serialize(), raw)
+        self.assertEqual(tx.identifier(), 'd869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c')
+
+    def test_sig_hash_bip143(self):
+        # the native p2wpkh example of BIP143
+        tx = Transaction.parse(BytesIO(bytes.fromhex('0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac11000000')))
+        context = tx.sighash_context()
+        self.assertEqual(context.hash_prevouts().hex(), '96b827c8483d4e9b96712b6713a7b68d6e8003a781feba36c31143470b4efd37')
+        self.assertEqual(context.hash_sequence().hex(), '52b0a642eea2fb7ae638c36f6252b6750293dbe574a806984b8e4d8548339a3b')
+        self.assertEqual(context.hash_outputs().hex(), '863ef3e1a92afbfdb97f31ad0fc7683ee943e9abcf2501590ff8f6551f47e5e5')
+        script_code = p2pkh_script(bytes.fromhex('1d0f172a0ecb48aee1be1f2687d2963ae33f71a1'))
+        want = int('c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670', 16)
+        self.assertEqual(context.segwit_sig_hash(1, script_code, 600000000), want)
+
+    def test_verify_segwit(self):
+        for tx_id in ('d869f854e1f8788bcff294cc83b280942a8c728de71eb709a2c29d10bfe21b7c',
+                      'c586389e5e4b3acb9d6c8be1c19ae8ab2795397633176f5a6442a261bbdefc3a',
+                      '78457666f82c28aa37b74b506745a7c7684dc7842a52a457b09f09446721e11c',
+                      '954f43dbb30ad8024981c07d1f5eb6c9fd461e2cf1760dd1283f052af746fc88'):
+            tx = TransactionFetcher.fetch(tx_id, testnet=True)
+            self.assertTrue(tx.verify())
+            witness = tx.tx_ins[0].witness
+            signature = witness[0][:-2] + bytes([witness[0][-2] ^ 1]) + witness[0][-1:]
+            tx.tx_ins[0].witness = [signature] + witness[1:]
+            self.assertFalse(tx.verify())
+            tx.tx_ins[0].witness = witness
+
+    def test_fetcher_cache(self):
+        tx_id = '452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03'
+        cache = TransactionFetcher.cache
+        TransactionFetcher.cache = LRUCache(maxsize=2, maxbytes=100000, sizeof=lambda tx: len(tx.serialize()))
+        try:
+            TransactionFetcher.load_cache(self.cache_file)
+            self.assertEqual(len(TransactionFetcher.cache), 2)
+            TransactionFetcher.cache.put(tx_id, cache[tx_id])
+            TransactionFetcher.cache.pin(tx_id)
+            TransactionFetcher.load_cache(self.cache_file)
+            # still cached, so no network
+            self.assertEqual(TransactionFetcher.fetch(tx_id).identifier(), tx_id)
+            stats = TransactionFetcher.cache.stats()
+            self.assertEqual((stats['pinned'], stats['hits']), (1, 1))
+            self.assertGreater(stats['evictions'], 0)
+        finally:
+            TransactionFetcher.cache = cache
+
+    def test_verify_p2wsh_without_p2sh(self):
+        tx = Transaction.parse(BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')), testnet=True)
+        # a witness script shaped like p2sh, fed a "RedeemScript" that fails
+        inner = bytes([0x00])
+        witness_script = Script([0xa9, hash160(inner), 0x87]).raw_serialize()
+        script_pubkey = Script([0x00, hashlib.sha256(witness_script).digest()])
+        tx.tx_ins[0].witness = [inner, witness_script]
+        tx.tx_ins[0].value = lambda testnet=False: 0
+        self.assertTrue(tx.verify_witness_input(0, script_pubkey))
+        tx.tx_ins[0].witness = [bytes([0x51]), witness_script]
+        self.assertFalse(tx.verify_witness_input(0, script_pubkey))
+
+    def test_sigop_count(self):
+        tx = TransactionFetcher.fetch('452c629d67e41baec3ac6f04fe744b4b9617f8f859c63b3002f8684e7a4fee03')
+        self.assertEqual(tx.sigop_count(), len(tx.tx_outs))
+        tx = TransactionFetcher.fetch('46df1a9484d0a81d03ce0ee543ab6e1a23ed06175c104a178268fad381216c2b')
+        legacy = tx.sigop_count()
+        self.assertEqual(tx.sigop_count(p2sh=True) - legacy, 2)
+
     def test_sign_input(self):
         private_key = PrivateKey(secret=8675309)
         stream = BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'))
         tx_obj = Transaction.parse(stream, testnet=True)
+        unsigned = tx_obj.identifier()
+        self.assertTrue(tx_obj.sign_input(0, private_key, SIGHASH_NONE | SIGHASH_ANYONECANPAY))
         self.assertTrue(tx_obj.sign_input(0, private_key))
+        self.assertNotEqual(tx_obj.identifier(), unsigned)
         want = '010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d0000006b4830450221008ed46aa2cf12d6d81065bfabe903670165b538f65ee9a3385e6327d80c66d3b502203124f804410527497329ec4715e18558082d489b218677bd029e7fa306a72236012103935581e52c354cd2f484fe8ed83af7a3097005b2f9c60bff71d35bd795f54b67ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000'
         self.assertEqual(tx_obj.serialize().hex(), want)
 
+    def test_sign_inputs_share_context(self):
+        private_key = PrivateKey(secret=8675309)
+        tx_obj = Transaction.parse(BytesIO(bytes.fromhex('010000000456919960ac691763688d3d3bcea9ad6ecaf875df5339e148a1fc61c6ed7a069e010000006a47304402204585bcdef85e6b1c6af5c2669d4830ff86e42dd205c0e089bc2a821657e951c002201024a10366077f87d6bce1f7100ad8cfa8a064b39d4e8fe4ea13a7b71aa8180f012102f0da57e85eec2934a82a585ea337ce2f4998b50ae699dd79f5880e253dafafb7feffffffeb8f51f4038dc17e6313cf831d4f02281c2a468bde0fafd37f1bf882729e7fd3000000006a47304402207899531a52d59a6de200179928ca900254a36b8dff8bb75f5f5d71b1cdc26125022008b422690b8461cb52c3cc30330b23d574351872b7c361e9aae3649071c1a7160121035d5c93d9ac96881f19ba1f686f15f009ded7c62efe85a872e6a19b43c15a2937feffffff567bf40595119d1bb8a3037c356efd56170b64cbcc160fb028fa10704b45d775000000006a47304402204c7c7818424c7f7911da6cddc59655a70af1cb5eaf17c69dadbfc74ffa0b662f02207599e08bc8023693ad4e9527dc42c34210f7a7d1d1ddfc8492b654a11e7620a0012102158b46fbdff65d0172b7989aec8850aa0dae49abfb84c81ae6e5b251a58ace5cfeffffffd63a5e6c16e620f86f375925b21cabaf736c779f88fd04dcad51d26690f7f345010000006a47304402200633ea0d3314bea0d95b3cd8dadb2ef79ea8331ffe1e61f762c0f6daea0fabde022029f23b3e9c30f080446150b23852028751635dcee2be669c2a1686a4b5edf304012103ffd6f4a67e94aba353a00882e563ff2722eb4cff0ad6006e86ee20dfe7520d55feffffff0251430f00000000001976a914ab0c0b2e98b1ab6dbf67d4750b0a56244948a87988ac005a6202000000001976a9143c82d7df364eb6c75be8c80df2b3eda8db57397088ac46430600')))
+        context = tx_obj.sighash_context()
+        identifier = tx_obj.identifier()
+        for i in range(len(tx_obj.tx_ins)):
+            # signing with another key changes the scripts, not the context
+            tx_obj.sign_input(i, private_key)
+            self.assertIs(tx_obj.sighash_context(), context)
+            self.assertIsNone(tx_obj._serialized)
+        self.assertNotEqual(tx_obj.identifier(), identifier)
+        tx_obj.tx_ins[0].witness = [b'\x00']
+        self.assertIs(tx_obj.sighash_context(), context)
+        tx_obj.tx_ins[0].sequence = 0
+        self.assertIsNot(tx_obj.sighash_context(), context)
+
+    def test_verify_hash_types(self):
+        first, second = PrivateKey(secret=8675309), PrivateKey(secret=8675310)
+        tx_obj = Transaction.parse(BytesIO(bytes.fromhex('010000000199a24308080ab26e6fb65c4eccfadf76749bb5bfa8cb08f291320b3c21e56f0d0d00000000ffffffff02408af701000000001976a914d52ad7ca9b3d096a38e752c2018e6fbc40cdf26f88ac80969800000000001976a914507b27411ccf7f16f10297de6cef3f291623eddf88ac00000000')), testnet=True)
+        tx_in = tx_obj.tx_ins[0]
+
+        def sign(private_key, hash_type):
+            z = tx_obj.sig_hash(0, hash_type=hash_type)
+            return private_key.sign(z).der() + bytes([hash_type])
+
+        sec = first.point.sec()
+        templates = (
+            (p2pkh_script(hash160(sec)), lambda sig: [sig, sec]),
+            (Script([sec, 0xac]), lambda sig: [sig]),
+        )
+        for hash_type in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE | SIGHASH_ANYONECANPAY):
+            # the fast path and the interpreter agree on every hash type
+            for script_pubkey, script_sig in templates:
+                tx_in.script_pubkey = lambda testnet=False: script_pubkey
+                tx_in.script_sig = Script(script_sig(sign(first, hash_type)))
+                self.assertTrue(tx_obj.verify_input(0))
+                combined = tx_in.script_sig + script_pubkey
+                self.assertTrue(combined.evaluate(lambda t: tx_obj.sig_hash(0, hash_type=t)))
+        # a multisig whose signatures use different hash types
+        multisig = Script([0x52, first.point.sec(), second.point.sec(), 0x52, 0xae])
+        tx_in.script_pubkey = lambda testnet=False: multisig
+        tx_in.script_sig = Script([0x00, sign(first, SIGHASH_ALL), sign(second, SIGHASH_NONE)])
+        self.assertTrue(tx_obj.verify_input(0))
+        self.assertIsNotNone(tx_obj.verify_standard_input(0, multisig))
+        combined = tx_in.script_sig + multisig
+        self.assertTrue(combined.evaluate(lambda t: tx_obj.sig_hash(0, hash_type=t)))
+        tx_in.script_sig = Script([0x00, sign(first, SIGHASH_NONE)[:-1] + bytes([SIGHASH_ALL]), sign(second, SIGHASH_NONE)])
+        self.assertFalse(tx_obj.verify_input(0))
+
     def test_create_transaction(self):
         secret = int.from_bytes(hash256(b'mimoserock test bitcoin private key 2024.11.15'), 'little')
         private_key = PrivateKey(secret=secret)
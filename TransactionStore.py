@@ -0,0 +1,246 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from io import BytesIO
+from unittest import TestCase
+
+from LRUCache import LRUCache
+from Transaction import Transaction, TransactionFetcher
+
+# an index record: txid as displayed, offset and length in the data file
+INDEX_RECORD = struct.Struct('<32sQI')
+
+
+class TransactionStore:
+    '''
+    Raw transactions on disk: an append-only data file (path + '.dat')
+    and an append-only index of (txid, offset, length) records
+    (path + '.idx'). Opening reads only the index; the data file is
+    memory-mapped and a transaction is parsed when it is looked up.
+    Records whose data never made it to disk, as after a crash between
+    the two writes, are ignored.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data_file = open(path + '.dat', 'a+b')
+        self.index_file = open(path + '.idx', 'a+b')
+        self.data_size = os.fstat(self.data_file.fileno()).st_size
+        self.data = None
+        self.index = {}
+        self.load_index()
+
+    def __repr__(self):
+        return 'TransactionStore({}, {} transactions)'.format(self.path, len(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, tx_id):
+        return bytes.fromhex(tx_id) in self.index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_index(self):
+        self.index_file.seek(0)
+        raw = self.index_file.read()
+        # a record cut short by a crash is dropped
+        end = len(raw) - len(raw) % INDEX_RECORD.size
+        for i, (tx_hash, offset, length) in enumerate(INDEX_RECORD.iter_unpack(raw[:end])):
+            if offset + length > self.data_size:
+                # records are appended in data order, so this one and any
+                # after it point at data that never made it to disk
+                end = i * INDEX_RECORD.size
+                break
+            self.index[tx_hash] = (offset, length)
+        if end != len(raw):
+            # cut the file back to its last good record, or the next
+            # append would land out of step with the record boundaries
+            self.index_file.truncate(end)
+
+    def mapped(self, end):
+        '''
+        returns the mapping of the data file, mapped again when it does
+        not reach end yet; callers hold the lock
+        '''
+        if self.data is None or len(self.data) < end:
+            if self.data is not None:
+                self.data.close()
+            self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data
+
+    def raw(self, tx_id):
+        '''
+        returns the serialized transaction, or None when it is not stored
+        '''
+        location = self.index.get(bytes.fromhex(tx_id))
+        if location is None:
+            return None
+        offset, length = location
+        with self.lock:
+            return self.mapped(offset + length)[offset:offset + length]
+
+    def get(self, tx_id, testnet=False):
+        '''
+        returns the parsed transaction, or None when it is not stored
+        '''
+        raw = self.raw(tx_id)
+        if raw is None:
+            return None
+        return Transaction.parse(BytesIO(raw), testnet=testnet)
+
+    def put_raw(self, tx_id, raw):
+        '''
+        appends a serialized transaction unless it is already stored
+        '''
+        tx_hash = bytes.fromhex(tx_id)
+        with self.lock:
+            if tx_hash in self.index:
+                return
+            # appends land at the end of the file, which a failed write may
+            # have moved past data_size
+            offset = self.data_file.seek(0, os.SEEK_END)
+            # the data goes to disk before the record that points at it
+            try:
+                self.data_file.write(raw)
+                self.data_file.flush()
+            except OSError:
+                # drop whatever part of it was written
+                self.data_file.truncate(offset)
+                raise
+            self.index_file.write(INDEX_RECORD.pack(tx_hash, offset, len(raw)))
+            self.index_file.flush()
+            self.data_size = offset + len(raw)
+            self.index[tx_hash] = (offset, len(raw))
+
+    def put(self, tx):
+        self.put_raw(tx.identifier(), tx.serialize())
+
+    def import_cache(self, filename):
+        '''
+        copies the entries of a TransactionFetcher.dump_cache JSON file
+        into the store, without parsing them, returns how many were new
+        '''
+        with open(filename, 'r') as f:
+            disk_cache = json.load(f)
+        count = len(self.index)
+        for tx_id, raw_hex in disk_cache.items():
+            self.put_raw(tx_id, bytes.fromhex(raw_hex))
+        return len(self.index) - count
+
+    def close(self):
+        with self.lock:
+            if self.data is not None:
+                self.data.close()
+                self.data = None
+            self.data_file.close()
+            self.index_file.close()
+
+
+class TransactionStoreTest(TestCase):
+    cache_file = 'transaction.cache'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'transactions')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_import(self):
+        with open(self.cache_file) as f:
+            disk_cache = json.load(f)
+        with TransactionStore(self.path) as store:
+            self.assertEqual(store.import_cache(self.cache_file), len(disk_cache))
+            self.assertEqual(store.import_cache(self.cache_file), 0)
+        with TransactionStore(self.path) as store:
+            self.assertEqual(len(store), len(disk_cache))
+            for tx_id, raw_hex in disk_cache.items():
+                self.assertIn(tx_id, store)
+                self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+                self.assertEqual(store.get(tx_id).identifier(), tx_id)
+            self.assertIsNone(store.get('00' * 32))
+
+    def test_append(self):
+        with open(self.cache_file) as f:
+            disk_cache = list(json.load(f).items())
+        store = TransactionStore(self.path)
+        tx_id, raw_hex = disk_cache[0]
+        store.put(Transaction.parse(BytesIO(bytes.fromhex(raw_hex))))
+        self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+        # appending after a lookup maps the grown file again
+        tx_id, raw_hex = disk_cache[1]
+        store.put_raw(tx_id, bytes.fromhex(raw_hex))
+        self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+        store.close()
+        # an index record written without its data is ignored
+        with open(self.path + '.idx', 'ab') as f:
+            f.write(INDEX_RECORD.pack(bytes(32), 1 << 20, 100) + b'\x00' * 5)
+        with TransactionStore(self.path) as store:
+            self.assertEqual(len(store), 2)
+            self.assertNotIn('00' * 32, store)
+            tx_id, raw_hex = disk_cache[2]
+            store.put_raw(tx_id, bytes.fromhex(raw_hex))
+        self.assertEqual(os.path.getsize(self.path + '.idx'), 3 * INDEX_RECORD.size)
+        with TransactionStore(self.path) as store:
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+
+    def test_append_after_partial_write(self):
+        with open(self.cache_file) as f:
+            disk_cache = list(json.load(f).items())
+        with TransactionStore(self.path) as store:
+            tx_id, raw_hex = disk_cache[0]
+            store.put_raw(tx_id, bytes.fromhex(raw_hex))
+            # bytes of a write that failed half way, behind the store's back
+            with open(self.path + '.dat', 'ab') as f:
+                f.write(b'\xff' * 7)
+            tx_id, raw_hex = disk_cache[1]
+            store.put_raw(tx_id, bytes.fromhex(raw_hex))
+            self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+            # a write that fails part way is cut off again
+            size = os.path.getsize(self.path + '.dat')
+            data_file = store.data_file
+
+            class Full:
+                def write(self, data):
+                    data_file.write(data[:3])
+                    data_file.flush()
+                    raise OSError(28, 'No space left on device')
+
+                def __getattr__(self, name):
+                    return getattr(data_file, name)
+
+            store.data_file = Full()
+            with self.assertRaises(OSError):
+                store.put_raw(disk_cache[2][0], bytes.fromhex(disk_cache[2][1]))
+            store.data_file = data_file
+            self.assertEqual(os.path.getsize(self.path + '.dat'), size)
+            self.assertNotIn(disk_cache[2][0], store)
+        with TransactionStore(self.path) as store:
+            self.assertEqual(store.raw(tx_id).hex(), raw_hex)
+
+    def test_fetcher(self):
+        with open(self.cache_file) as f:
+            tx_id, raw_hex = next(iter(json.load(f).items()))
+        cache, store = TransactionFetcher.cache, TransactionFetcher.store
+        TransactionFetcher.cache = LRUCache()
+        try:
+            with TransactionStore(self.path) as store:
+                store.put_raw(tx_id, bytes.fromhex(raw_hex))
+                TransactionFetcher.use_store(store)
+                tx = TransactionFetcher.fetch(tx_id)
+                self.assertEqual(tx.serialize().hex(), raw_hex)
+                self.assertIs(TransactionFetcher.fetch(tx_id), tx)
+        finally:
+            TransactionFetcher.cache = cache
+            TransactionFetcher.use_store(None)